@@ -0,0 +1,162 @@
+from .board import Board, Zobrist
+
+class BitBoard(Board):
+    # The board backend which keeps the stones of each color in a Python
+    # big-int bitboard. The bit of a vertex is (1 << vtx), so the border
+    # of the mailbox state keeps the shifts from wrapping around the edges.
+    # The bitboards are the stone_bits of the Board. The strings are not
+    # stored; flood fills, liberties and captures are shift/mask operations
+    # on the whole board. The state is still kept for the public API.
+
+    def _reset_strings(self):
+        self.board_mask = 0
+        for idx in range(self.num_intersections):
+            self.board_mask |= 1 << self.index_to_vertex(idx)
+
+    def _copy_strings(self, other):
+        self.board_mask = other.board_mask
+
+    def _setup_strings(self):
+        # The stone bits are the strings.
+        pass
+
+    def _dilate(self, bits):
+        shift = self.board_size + 2
+        return ((bits << 1) | (bits >> 1) | \
+                    (bits << shift) | (bits >> shift)) & self.board_mask
+
+    def _flood(self, seed, color_bits):
+        string = seed
+        while True:
+            grown = (string | self._dilate(string)) & color_bits
+            if grown == string:
+                return string
+            string = grown
+
+    def _iter_strings(self, color_bits):
+        while color_bits:
+            string = self._flood(color_bits & -color_bits, color_bits)
+            color_bits &= ~string
+            yield string
+
+    def _get_empty_bits(self):
+        return self.board_mask & ~(self.stone_bits[self.BLACK] | self.stone_bits[self.WHITE])
+
+    def _bits_to_vertices(self, bits):
+        vertices = list()
+        while bits:
+            low = bits & -bits
+            vertices.append(low.bit_length() - 1)
+            bits ^= low
+        return vertices
+
+    def _get_string_stones(self, vtx):
+        color = self.state[vtx]
+        if not color in [self.BLACK, self.WHITE]:
+            return list()
+        return self._bits_to_vertices(
+                   self._flood(1 << vtx, self.stone_bits[color]))
+
+    def _get_captured_bits(self, vtx, to_move):
+        # The opp's strings which lose the last liberty by the move.
+        bit = 1 << vtx
+        opp_bits = self.stone_bits[self.invert_color_map[to_move]]
+        empty = self._get_empty_bits()
+        captured = 0
+        neighbours = self._dilate(bit) & opp_bits
+        while neighbours:
+            string = self._flood(neighbours & -neighbours, opp_bits)
+            neighbours &= ~string
+            if self._dilate(string) & empty == bit:
+                captured |= string
+        return captured
+
+    def _legal_vertex(self, vtx, to_move):
+        if vtx == self.ko[to_move] or self.state[vtx] != self.EMPTY:
+            return False
+
+        bit = 1 << vtx
+        empty = self._get_empty_bits()
+        if self._dilate(bit) & empty:
+            # we at least have one liberty
+            return self._superko_legal(vtx, to_move)
+
+        string = self._flood(bit, self.stone_bits[to_move] | bit)
+        if self._dilate(string) & empty & ~bit:
+            # merge with a string which has other liberties
+            return self._superko_legal(vtx, to_move)
+        if self._get_captured_bits(vtx, to_move):
+            # we can capture opp's stones
+            return self._superko_legal(vtx, to_move)
+        # suicide move
+        return False
+
+    def _compute_legal_mask(self, to_move):
+        own_bits = self.stone_bits[to_move]
+        opp_bits = self.stone_bits[self.invert_color_map[to_move]]
+        empty = self._get_empty_bits()
+
+        # The points next to an empty point, the liberties of our strings
+        # which have more than one liberty and the last liberties of the
+        # opp's strings.
+        legal = empty & self._dilate(empty)
+        for string in self._iter_strings(own_bits):
+            libs = self._dilate(string) & empty
+            if libs.bit_count() > 1:
+                legal |= libs
+        for string in self._iter_strings(opp_bits):
+            libs = self._dilate(string) & empty
+            if libs.bit_count() == 1:
+                legal |= libs
+
+        ko = self.ko[to_move]
+        if ko != self.NULL_VERTEX:
+            legal &= ~(1 << ko)
+
+        mask = bytearray(self.num_intersections)
+        for vtx in self._bits_to_vertices(legal):
+            if self._superko_legal(vtx, to_move):
+                mask[self.get_index(*self.vertex_to_xy(vtx))] = True
+        return mask
+
+    def _superko_legal(self, vtx, to_move):
+        if self.key_history is None:
+            return True
+
+        opp_color = self.invert_color_map[to_move]
+        key = self.position_key ^ Zobrist.STONE[to_move][vtx]
+        for svtx in self._bits_to_vertices(self._get_captured_bits(vtx, to_move)):
+            key ^= Zobrist.STONE[opp_color][svtx]
+        if self.superko_rule == self.SUPERKO_SITUATIONAL and \
+               opp_color == self.WHITE:
+            key ^= Zobrist.TO_MOVE
+        return not key in self._get_key_counts()
+
+    def _update_board(self, vtx):
+        color = self.to_move
+        opp_color = self.invert_color_map[color]
+
+        # remove dead stones
+        captured = self._get_captured_bits(vtx, color)
+        captured_vtx = self._bits_to_vertices(captured)
+        self.stone_bits[opp_color] &= ~captured
+        for svtx in captured_vtx:
+            self.position_key ^= Zobrist.STONE[opp_color][svtx]
+            self.state[svtx] = self.EMPTY
+        self.prisoners[color] += len(captured_vtx)
+
+        bit = 1 << vtx
+        self.stone_bits[color] |= bit
+        self.state[vtx] = color
+        self.position_key ^= Zobrist.STONE[color][vtx]
+
+        # get ko vertex
+        if len(captured_vtx) == 1 and \
+               not self._dilate(bit) & self.stone_bits[color] and \
+               (self._dilate(bit) & self._get_empty_bits()).bit_count() == 1:
+            return captured_vtx[0], captured_vtx
+        return self.NULL_VERTEX, captured_vtx
+
+    def _restore_strings(self, vtx, captured_vtx):
+        # undo() has put back the stone bits.
+        pass
@@ -1,5 +1,24 @@
 from .gtp import GtpColor, GtpVertex
+from array import array
 import copy
+import random
+import struct
+
+def _random_keys(rng, size):
+    return [rng.getrandbits(64) for _ in range(size)]
+
+class Zobrist:
+    # The random keys are drawn from a fixed seed so that the hash of a
+    # position is the same in every process.
+    SEED = 5489
+    MAX_VERTICES = (25 + 2) ** 2
+
+    _rng = random.Random(SEED)
+    STONE = [_random_keys(_rng, MAX_VERTICES), _random_keys(_rng, MAX_VERTICES)]
+    KO = _random_keys(_rng, MAX_VERTICES)
+    SIZE = _random_keys(_rng, 25 + 1)
+    TO_MOVE = _rng.getrandbits(64)
+    del _rng
 
 class Board:
     X_LABELS = "ABCDEFGHJKLMNOPQRSTUVWXYZ"
@@ -16,7 +35,33 @@ class Board:
     RESIGN_VERTEX = 100 * 100 + 1
     NULL_VERTEX = 100 * 100 + 2
 
-    def __init__(self, board_size, komi, scoring_rule):
+    MAX_DIRTY_LOG = 4096
+
+    # version, board size, to move, scoring rule, passes, ko index,
+    # prisoners and komi
+    SERIAL_VERSION = 1
+    SERIAL_HEADER = struct.Struct("<BBBBBHHHd")
+    SERIAL_NULL_INDEX = 0xffff
+
+    SUPERKO_NONE = 0
+    SUPERKO_POSITIONAL = 1
+    SUPERKO_SITUATIONAL = 2
+
+    BACKEND_MAILBOX = "mailbox"
+    BACKEND_BITBOARD = "bitboard"
+
+    def __new__(cls, *args, backend=None, **kwargs):
+        # The backend only changes how the strings are computed. Both of
+        # them share the public API.
+        if cls is Board and backend == cls.BACKEND_BITBOARD:
+            from .bitboard import BitBoard
+            cls = BitBoard
+        elif not backend in [None, cls.BACKEND_MAILBOX, cls.BACKEND_BITBOARD]:
+            raise Exception("Unknown board backend.")
+        return super(Board, cls).__new__(cls)
+
+    def __init__(self, board_size, komi, scoring_rule, superko_rule=SUPERKO_NONE, backend=None):
+        self.superko_rule = self._get_fancy_superko_rule(superko_rule)
         self.reset(board_size, komi, scoring_rule)
 
     def reset(self, board_size, komi, scoring_rule):
@@ -30,42 +75,122 @@ class Board:
         self.last_move = self.NULL_VERTEX
         self.ko = [self.NULL_VERTEX, self.NULL_VERTEX]
 
-        self.state = [None] * self.num_vertices
-        for vtx in range(self.num_vertices):
-            self.state[vtx] = self.INVLD
+        # The board state is kept in flat byte arrays, so a copy is only a
+        # few memcpy.
+        self.state = bytearray([self.INVLD]) * self.num_vertices
         for idx in range(self.num_intersections):
             self.state[self.index_to_vertex(idx)] = self.EMPTY
 
-        self.deadmark = [False] * self.num_vertices
+        self.deadmark = bytearray(self.num_vertices)
+
         self.prisoners = [0, 0]
-        self.invert_color_map = [self.WHITE, self.BLACK, self.EMPTY, self.INVLD]
-        self.dir4 = [1, self.board_size+2, -1, -(self.board_size+2)]
+        self.invert_color_map = (self.WHITE, self.BLACK, self.EMPTY, self.INVLD)
+        self.dir4 = (1, self.board_size+2, -1, -(self.board_size+2))
+        self._reset_strings()
         self.scoring_rule = self._get_fancy_scoring_rule(scoring_rule)
 
+        # Zobrist key of the stones only. The side to move and the ko are
+        # mixed in by hash_key.
+        self.position_key = Zobrist.SIZE[self.board_size]
+
+        # Stones of each color as the int bit set, the bit of a vertex is
+        # (1 << vtx), and the log of the changed vertices, so that the
+        # callers need not scan the whole board. The ints are immutable and
+        # shared by the copies.
+        self.stone_bits = [0, 0]
+        self._bump_version()
+
+        # Records of the played moves for undo().
+        self.history = None
+        self._clear_cache()
+
+        # Keys of the previous positions, only kept for the superko rules.
+        # Like the history, they are a linked list of tuples shared by the
+        # copies. The counts for the lookup belong to one board and are
+        # built from the list when they are first needed.
+        self.key_history = None
+        self._key_counts = None
+        if self.superko_rule != self.SUPERKO_NONE:
+            self._key_counts = dict()
+            self._push_key_history()
+
+    @property
+    def hash_key(self):
+        key = self.position_key
+        if self.to_move == self.WHITE:
+            key ^= Zobrist.TO_MOVE
+        ko = self.ko[self.to_move]
+        if ko != self.NULL_VERTEX:
+            key ^= Zobrist.KO[ko]
+        return key
+
     def copy(self):
-        cp_board = Board(self.board_size, self.komi, self.scoring_rule)
-        cp_board.num_passes = self.num_passes
-        cp_board.num_move = self.num_move
-        cp_board.komi = self.komi
-        cp_board.to_move = self.to_move
-        cp_board.last_move = self.last_move
-        cp_board.ko = self.ko[:]
-        cp_board.state[:] = self.state[:]
-        cp_board.deadmark[:] = self.deadmark[:]
-        cp_board.prisoners[:] = self.prisoners[:]
+        cp_board = self.__class__.__new__(self.__class__)
+        cp_board._copy_state(self)
         return cp_board
 
     def copy_from(self, other):
-        self.reset(other.board_size, other.komi, other.scoring_rule)
+        self._copy_state(other)
+
+    def _copy_state(self, other):
+        # Copy every field without going through reset(). The read-only
+        # tables are shared between the boards.
+        self.board_size = other.board_size
+        self.num_intersections = other.num_intersections
+        self.num_vertices = other.num_vertices
         self.num_passes = other.num_passes
         self.num_move = other.num_move
         self.komi = other.komi
         self.to_move = other.to_move
         self.last_move = other.last_move
         self.ko = other.ko[:]
-        self.state[:] = other.state[:]
-        self.deadmark[:] = other.deadmark[:]
-        self.prisoners[:] = other.prisoners[:]
+        self.state = other.state[:]
+        self.deadmark = other.deadmark[:]
+        self.prisoners = other.prisoners[:]
+        self.invert_color_map = other.invert_color_map
+        self.dir4 = other.dir4
+        self.scoring_rule = other.scoring_rule
+        self.superko_rule = other.superko_rule
+        self.position_key = other.position_key
+        self.stone_bits = other.stone_bits[:]
+        self._bump_version(other.version)
+        self.history = other.history
+        if other.__class__ is self.__class__:
+            self._copy_strings(other)
+        else:
+            # The other board uses another backend.
+            self._reset_strings()
+            self._setup_strings()
+        self._clear_cache()
+        self.key_history = other.key_history
+        self._key_counts = None
+
+    def _bump_version(self, other_version=0):
+        # The whole board is replaced. The version never goes back, so a
+        # caller which holds an older version is told to redraw the whole
+        # board.
+        self.version = max(getattr(self, "version", 0), other_version) + 1
+        self._dirty_base = self.version
+        self._dirty_log = list()
+
+    def _reset_strings(self):
+        # String (chain) data. Every stone points to the head vertex of its
+        # string, the stones of one string form a circular linked list, and the
+        # liberty count is kept on the head vertex.
+        self.parent = array("H", [self.num_vertices]) * self.num_vertices
+        self.next_stone = array("H", range(self.num_vertices))
+        self.string_size = array("H", [0]) * self.num_vertices
+        self.libs = array("H", [0]) * self.num_vertices
+
+    def _copy_strings(self, other):
+        self.parent = other.parent[:]
+        self.next_stone = other.next_stone[:]
+        self.string_size = other.string_size[:]
+        self.libs = other.libs[:]
+
+    def _clear_cache(self):
+        self._final_result = None
+        self._legal_mask = [None, None]
 
     def legal(self, vtx, to_move=None):
         vtx = self._get_fancy_vertex(vtx)
@@ -75,26 +200,50 @@ class Board:
             to_move = self.to_move
         if vtx in [self.PASS_VERTEX, self.RESIGN_VERTEX]:
             return True
+        return self._legal_vertex(vtx, to_move)
+
+    def legal_mask(self, to_move=None):
+        # Return the legal flag of every intersection in the row-major
+        # order, see get_index(). The mask is cached until the board is
+        # changed.
+        to_move = self._get_fancy_color(to_move)
+        if to_move is None:
+            to_move = self.to_move
+
+        mask = self._legal_mask[to_move]
+        if mask is None:
+            mask = self._compute_legal_mask(to_move)
+            self._legal_mask[to_move] = mask
+        return mask
+
+    def _compute_legal_mask(self, to_move):
+        mask = bytearray(self.num_intersections)
+        for idx in range(self.num_intersections):
+            if self._legal_vertex(self.index_to_vertex(idx), to_move):
+                mask[idx] = True
+        return mask
+
+    def _legal_vertex(self, vtx, to_move):
         if vtx == self.ko[to_move] or self.state[vtx] != self.EMPTY:
             return False
 
-        our_surround = set()
         for d in self.dir4:
             nvtx = vtx + d
             color = self.state[nvtx]
 
             if color == self.EMPTY:
                 # we at least have one liberty
-                return True
+                return self._superko_legal(vtx, to_move)
             elif color == to_move:
-                _, our_surround = self._search_string(nvtx, our_surround)
+                if self.libs[self.parent[nvtx]] > 1:
+                    # merge with a string which has other liberties
+                    return self._superko_legal(vtx, to_move)
             elif color == self.invert_color_map[to_move]:
-                _, opp_surround = self._search_string(nvtx)
-                if len(opp_surround) <= 1:
+                if self.libs[self.parent[nvtx]] == 1:
                     # we can capture opp's stones
-                    return True
-        # at least need one liberty
-        return len(our_surround) > 1
+                    return self._superko_legal(vtx, to_move)
+        # suicide move
+        return False
 
     def play(self, vtx, to_move=None):
         vtx = self._get_fancy_vertex(vtx)
@@ -105,30 +254,191 @@ class Board:
         if to_move and not to_move in [self.BLACK, self.WHITE]:
             raise Exception("The to-move color should be BLACK/WHITE.")
 
-        if not to_move is None:
-            self.to_move = to_move
-
+        if to_move is None:
+            to_move = self.to_move
+        self._play_vertex(vtx, to_move)
+
+    def play_sequence(self, moves, colors=None, validate=True):
+        # Play a sequence of raw vertices, for example a list or an
+        # array("H"). The colors alternate from the side to move unless
+        # they are given. Other vertex/color types are converted as in
+        # play(), which is slower. If validate is set, an illegal move raises the
+        # exception and the moves before it stay on the board.
+        if colors is None:
+            for vtx in moves:
+                if not isinstance(vtx, int):
+                    vtx = self._get_fancy_vertex(vtx)
+                if validate and \
+                       not vtx in [self.PASS_VERTEX, self.RESIGN_VERTEX] and \
+                       not self._legal_vertex(vtx, self.to_move):
+                    raise Exception("Not a legal move.")
+                self._play_vertex(vtx, self.to_move)
+        else:
+            for vtx, to_move in zip(moves, colors):
+                if not isinstance(vtx, int):
+                    vtx = self._get_fancy_vertex(vtx)
+                if not isinstance(to_move, int):
+                    to_move = self._get_fancy_color(to_move)
+                if validate and \
+                       not vtx in [self.PASS_VERTEX, self.RESIGN_VERTEX] and \
+                       not self._legal_vertex(vtx, to_move):
+                    raise Exception("Not a legal move.")
+                self._play_vertex(vtx, to_move)
+
+    def _play_vertex(self, vtx, to_move):
+        prev_state = (self.to_move, self.ko[:], self.num_passes, self.last_move)
         if vtx == self.RESIGN_VERTEX:
+            # The resign changes only the side to move, but it still has
+            # a record, so undo() takes back the resign and not the move
+            # before it.
+            self.history = ((vtx, to_move, list(), prev_state), self.history)
+            self.to_move = to_move
             return
-        elif vtx == self.PASS_VERTEX:
+
+        self.to_move = to_move
+
+        captured_vtx = list()
+        if vtx == self.PASS_VERTEX:
             self.ko = [self.NULL_VERTEX, self.NULL_VERTEX]
             self.num_passes += 1
         else:
             self.num_passes = 0
             self.ko[self.to_move] = self.NULL_VERTEX
-            self.ko[self.invert_color_map[self.to_move]] = self._update_board(vtx)
+            self.ko[self.invert_color_map[self.to_move]], captured_vtx = \
+                self._update_board(vtx)
+
+        self._clear_cache()
+        self._mark_dirty([vtx, self.last_move] + captured_vtx)
+
+        # Push the move record on the history. The history is a linked list
+        # of tuples, so the copies of the board can share it.
+        self.history = ((vtx, self.to_move, captured_vtx, prev_state), self.history)
+
         self.last_move = vtx
         self.to_move = self.invert_color_map[self.to_move]
         self.num_move += 1
+        if not self.key_history is None:
+            self._push_key_history()
+
+    def undo(self):
+        if self.history is None:
+            return False
+        (vtx, color, captured_vtx, prev_state), self.history = self.history
+        self._clear_cache()
+
+        if vtx == self.RESIGN_VERTEX:
+            self.to_move = prev_state[0]
+            return True
+
+        if not self.key_history is None:
+            self._pop_key_history()
+
+        if vtx != self.PASS_VERTEX:
+            opp_color = self.invert_color_map[color]
+
+            # take back the move stone and put back the captured stones
+            self.state[vtx] = self.EMPTY
+            self.deadmark[vtx] = False
+            self.stone_bits[color] &= ~(1 << vtx)
+            self.position_key ^= Zobrist.STONE[color][vtx]
+            for svtx in captured_vtx:
+                self.state[svtx] = opp_color
+                self.stone_bits[opp_color] |= 1 << svtx
+                self.position_key ^= Zobrist.STONE[opp_color][svtx]
+            self.prisoners[color] -= len(captured_vtx)
+            self._restore_strings(vtx, captured_vtx)
+
+        self._mark_dirty([vtx, prev_state[3]] + captured_vtx)
+        self.to_move, self.ko, self.num_passes, self.last_move = prev_state
+        self.num_move -= 1
+        return True
+
+    def _mark_dirty(self, vertices):
+        self.version += 1
+        for vtx in vertices:
+            if vtx < self.num_vertices:
+                self._dirty_log.append((self.version, vtx))
+        if len(self._dirty_log) > self.MAX_DIRTY_LOG:
+            # forget the older half of the log
+            drop = len(self._dirty_log) // 2
+            self._dirty_base = self._dirty_log[drop - 1][0]
+            del self._dirty_log[:drop]
+
+    def get_changes_since(self, version):
+        # Return the coordinates changed after the given version, or None if
+        # the log does not go back so far. The caller should redraw the
+        # whole board then.
+        if version < self._dirty_base:
+            return None
+        changes = set()
+        for ver, vtx in reversed(self._dirty_log):
+            if ver <= version:
+                break
+            changes.add(self.vertex_to_xy(vtx))
+        return changes
+
+    def _superko_legal(self, vtx, to_move):
+        if self.key_history is None:
+            return True
+
+        # The position key after playing the move, including the captured
+        # opp's strings.
+        opp_color = self.invert_color_map[to_move]
+        key = self.position_key ^ Zobrist.STONE[to_move][vtx]
+        captured = list()
+        for d in self.dir4:
+            nvtx = vtx + d
+            if self.state[nvtx] == opp_color:
+                ip = self.parent[nvtx]
+                if self.libs[ip] == 1 and not ip in captured:
+                    captured.append(ip)
+                    for svtx in self._get_string_stones(ip):
+                        key ^= Zobrist.STONE[opp_color][svtx]
+        if self.superko_rule == self.SUPERKO_SITUATIONAL and \
+               opp_color == self.WHITE:
+            key ^= Zobrist.TO_MOVE
+        return not key in self._get_key_counts()
+
+    def _get_history_key(self):
+        key = self.position_key
+        if self.superko_rule == self.SUPERKO_SITUATIONAL and \
+               self.to_move == self.WHITE:
+            key ^= Zobrist.TO_MOVE
+        return key
+
+    def _push_key_history(self):
+        key = self._get_history_key()
+        self.key_history = (key, self.key_history)
+        if not self._key_counts is None:
+            self._key_counts[key] = self._key_counts.get(key, 0) + 1
+
+    def _pop_key_history(self):
+        key, self.key_history = self.key_history
+        if not self._key_counts is None:
+            self._key_counts[key] -= 1
+            if self._key_counts[key] == 0:
+                self._key_counts.pop(key)
+
+    def _get_key_counts(self):
+        if self._key_counts is None:
+            counts = dict()
+            node = self.key_history
+            while not node is None:
+                key, node = node
+                counts[key] = counts.get(key, 0) + 1
+            self._key_counts = counts
+        return self._key_counts
 
     def mark_dead(self, vtx):
         vtx = self._get_fancy_vertex(vtx)
         if not self.state[vtx] in [self.BLACK, self.WHITE]:
             return False
 
-        opp_string, _ = self._search_string(vtx)
-        for vtx in opp_string:
-            self.deadmark[vtx] ^= True
+        string_vtx = self._get_string_stones(vtx)
+        for svtx in string_vtx:
+            self.deadmark[svtx] ^= True
+        self._final_result = None
+        self._mark_dirty(string_vtx)
         return True
 
     def is_star(self, vtx):
@@ -161,90 +471,103 @@ class Board:
     def get_stone(self, vtx):
         return self.state[self._get_fancy_vertex(vtx)]
 
+    def get_stones(self, color):
+        # The vertices of the stones of the color, in the increasing order.
+        vertices = list()
+        bits = self.stone_bits[color]
+        while bits:
+            low = bits & -bits
+            vertices.append(low.bit_length() - 1)
+            bits ^= low
+        return vertices
+
+    def count_stones(self, color):
+        return self.stone_bits[color].bit_count()
+
     def get_stones_coord(self):
         stones_coord = list()
-        for x, y in [ self.index_to_xy(idx) for idx in range(self.num_intersections)]:
-            color = self.get_stone((x,y))
-            if not self.deadmark[self.get_vertex(x,y)] \
-                   and color in [self.BLACK, self.WHITE]:
-                stones_coord.append((color, x, y))
+        for color in [self.BLACK, self.WHITE]:
+            for vtx in self.get_stones(color):
+                if not self.deadmark[vtx]:
+                    x, y = self.vertex_to_xy(vtx)
+                    stones_coord.append((color, x, y))
         return stones_coord
 
     def get_deadstones_coord(self):
         deadstones_coord = list()
-        for x, y in [ self.index_to_xy(idx) for idx in range(self.num_intersections)]:
-            color = self.get_stone((x,y))
-            if self.deadmark[self.get_vertex(x,y)] \
-                   and color in [self.BLACK, self.WHITE]:
-                deadstones_coord.append((color, x, y))
+        for color in [self.BLACK, self.WHITE]:
+            for vtx in self.get_stones(color):
+                if self.deadmark[vtx]:
+                    x, y = self.vertex_to_xy(vtx)
+                    deadstones_coord.append((color, x, y))
         return deadstones_coord
 
     def get_finalpos_coord(self):
-        finalpos = [None] * self.num_vertices
-        finalpos[:] = self.state[:]
-        subareas = [set(), set(), set(), set()]
-        for vtx in range(self.num_vertices):
-            if self.deadmark[vtx]:
-                finalpos[vtx] = self.EMPTY
-            if finalpos[vtx] in [self.BLACK, self.WHITE]:
-                subareas[finalpos[vtx]].add(vtx)
-
-        area = subareas[self.BLACK] | subareas[self.WHITE] | subareas[self.EMPTY]
-        for vtx in range(self.num_vertices):
-            if finalpos[vtx] == self.EMPTY and not vtx in area:
-                belong = None
-                que = [vtx]
-                currarea = {vtx}
-                while len(que) != 0:
-                    nvtx = que.pop(0)
-                    for d in self.dir4:
-                        svtx = nvtx + d
-                        scolor = finalpos[svtx]
-                        if scolor == self.EMPTY and not svtx in currarea:
-                            que.append(svtx)
-                            currarea.add(svtx)
-                        elif scolor in [self.BLACK, self.WHITE]:
-                            if belong is None:
-                                belong = scolor
-                            elif belong == scolor:
-                                pass
-                            elif belong in [self.BLACK, self.WHITE]:
-                                belong = self.EMPTY
-                subareas[self.EMPTY if belong is None else belong] |= currarea
-                area = subareas[self.BLACK] | subareas[self.WHITE] | subareas[self.EMPTY]
-
+        owner, _, _, _ = self._get_final_result()
         finalpos_coord = list()
         for color in [self.BLACK, self.WHITE, self.EMPTY]:
-            for vtx in subareas[color]:
-                x, y = self.vertex_to_xy(vtx)
-                finalpos_coord.append((color, x, y))
+            for vtx in range(self.num_vertices):
+                if owner[vtx] == color:
+                    x, y = self.vertex_to_xy(vtx)
+                    finalpos_coord.append((color, x, y))
         return finalpos_coord
 
     def get_finalscore_statistics(self):
-        deadstones_coord = self.get_deadstones_coord()
-        finalpos_coord = self.get_finalpos_coord()
+        _, territory, stones, prisoners = self._get_final_result()
+        return territory[:], stones[:], prisoners[:]
 
-        prisoners = self.prisoners[:]
-        deadstones_buf = list()
-        for color, x, y in deadstones_coord:
-            if color in [self.BLACK, self.WHITE]:
-                prisoners[self.get_invert_color(color)] += 1
-                deadstones_buf.append((x, y))
+    def _get_final_result(self):
+        # The result is cached until the board is changed.
+        if not self._final_result is None:
+            return self._final_result
 
+        owner = self.state[:]
+        prisoners = self.prisoners[:]
         stones = [0, 0]
         territory = [0, 0]
-        for color, x, y in finalpos_coord:
-            if not color in [self.BLACK, self.WHITE]:
-                continue
-            stone = self.get_stone((x, y))
+        for vtx in range(self.num_vertices):
+            color = owner[vtx]
+            if color == self.BLACK or color == self.WHITE:
+                if self.deadmark[vtx]:
+                    owner[vtx] = self.EMPTY
+                    prisoners[self.invert_color_map[color]] += 1
+                else:
+                    stones[color] += 1
 
-            if not (x, y) in deadstones_buf and \
-                   stone in [self.BLACK, self.WHITE] and \
-                   stone == color:
-                stones[color] += 1
+        # Label every empty region, including the dead stones, in one pass.
+        # The region belongs to a color if it only touches that color.
+        seen = bytearray(self.num_vertices)
+        for vtx in range(self.num_vertices):
+            if owner[vtx] != self.EMPTY or seen[vtx]:
+                continue
+            region = [vtx]
+            seen[vtx] = True
+            touched = 0
+            idx = 0
+            while idx < len(region):
+                pos = region[idx]
+                idx += 1
+                for d in self.dir4:
+                    nvtx = pos + d
+                    color = owner[nvtx]
+                    if color == self.EMPTY:
+                        if not seen[nvtx]:
+                            seen[nvtx] = True
+                            region.append(nvtx)
+                    elif color == self.BLACK or color == self.WHITE:
+                        touched |= 1 << color
+            if touched == 1 << self.BLACK:
+                belong = self.BLACK
+            elif touched == 1 << self.WHITE:
+                belong = self.WHITE
             else:
-                territory[color] += 1
-        return territory, stones, prisoners
+                continue
+            territory[belong] += len(region)
+            for pos in region:
+                owner[pos] = belong
+
+        self._final_result = (owner, territory, stones, prisoners)
+        return self._final_result
 
     def compute_finalscore(self, color):
         territory, stones, prisoners = self.get_finalscore_statistics()
@@ -266,48 +589,163 @@ class Board:
         return blackscore
 
     def _update_board(self, vtx):
-        self.state[vtx] = self.to_move
-        captured_vtx = set()
+        color = self.to_move
+        opp_color = self.invert_color_map[color]
+
+        self.state[vtx] = color
+        self.stone_bits[color] |= 1 << vtx
+        self.position_key ^= Zobrist.STONE[color][vtx]
+        self.parent[vtx] = vtx
+        self.next_stone[vtx] = vtx
+        self.string_size[vtx] = 1
+        self.libs[vtx] = sum(1 for d in self.dir4 if self.state[vtx + d] == self.EMPTY)
+        self._add_neighbour(vtx)
 
         # remove dead stones
+        captured_vtx = list()
         for d in self.dir4:
             nvtx = vtx + d
-            if self.state[nvtx] == self.invert_color_map[self.to_move]:
-                opp_string, opp_surround = self._search_string(nvtx)
-                if len(opp_surround) == 0:
-                    for svtx in opp_string:
-                        self.state[svtx] = self.EMPTY
-                    captured_vtx |= opp_string
-        self.prisoners[self.to_move] += len(captured_vtx)
+            if self.state[nvtx] == opp_color and \
+                   self.libs[self.parent[nvtx]] == 0:
+                captured_vtx.extend(self._remove_string(nvtx))
+        self.prisoners[color] += len(captured_vtx)
+
+        # merge our strings, the smaller one is merged into the bigger one
+        for d in self.dir4:
+            nvtx = vtx + d
+            if self.state[nvtx] == color:
+                ip = self.parent[vtx]
+                aip = self.parent[nvtx]
+                if ip == aip:
+                    continue
+                if self.string_size[ip] >= self.string_size[aip]:
+                    self._merge_strings(ip, aip)
+                else:
+                    self._merge_strings(aip, ip)
 
         # get ko vertex
-        our_string, our_surround = self._search_string(vtx)
-        if len(our_string) == 1 and \
-               len(our_surround) == 1 and \
+        ip = self.parent[vtx]
+        if self.string_size[ip] == 1 and \
+               self.libs[ip] == 1 and \
                len(captured_vtx) == 1:
-            return list(captured_vtx)[0]
-        return self.NULL_VERTEX
+            return captured_vtx[0], captured_vtx
+        return self.NULL_VERTEX, captured_vtx
 
-    def _search_string(self, vtx, surround=None):
+    def _add_neighbour(self, vtx):
+        # The vertex is not empty now. Every adjacent string loses one liberty.
+        seen = list()
+        for d in self.dir4:
+            nvtx = vtx + d
+            if self.state[nvtx] in [self.BLACK, self.WHITE]:
+                ip = self.parent[nvtx]
+                if not ip in seen:
+                    self.libs[ip] -= 1
+                    seen.append(ip)
+
+    def _remove_neighbour(self, vtx):
+        # The vertex is empty now. Every adjacent string gains one liberty.
+        seen = list()
+        for d in self.dir4:
+            nvtx = vtx + d
+            if self.state[nvtx] in [self.BLACK, self.WHITE]:
+                ip = self.parent[nvtx]
+                if not ip in seen:
+                    self.libs[ip] += 1
+                    seen.append(ip)
+
+    def _merge_strings(self, ip, aip):
+        # Merge the string aip into the string ip. A liberty of aip is
+        # counted only if it is not the liberty of ip yet.
+        self.string_size[ip] += self.string_size[aip]
+        pos = aip
+        while True:
+            for d in self.dir4:
+                nvtx = pos + d
+                if self.state[nvtx] == self.EMPTY:
+                    shared = False
+                    for dd in self.dir4:
+                        if self.parent[nvtx + dd] == ip:
+                            shared = True
+                            break
+                    if not shared:
+                        self.libs[ip] += 1
+            self.parent[pos] = ip
+            pos = self.next_stone[pos]
+            if pos == aip:
+                break
+        self.next_stone[ip], self.next_stone[aip] = \
+            self.next_stone[aip], self.next_stone[ip]
+
+    def _remove_string(self, vtx):
+        removed_vtx = self._get_string_stones(vtx)
         color = self.state[vtx]
-        string_vtx = set()
-        surround_vtx = set() if surround is None else surround
-
-        if color in [self.EMPTY, self.INVLD]:
-            return string_vtx, len(surround_vtx)
-
-        que = [vtx]
-        string_vtx.add(vtx)
-        while len(que) != 0:
-            nvtx = que.pop(0)
+        for svtx in removed_vtx:
+            self.position_key ^= Zobrist.STONE[color][svtx]
+            self.state[svtx] = self.EMPTY
+            self.stone_bits[color] &= ~(1 << svtx)
+            self.parent[svtx] = self.num_vertices
+            self._remove_neighbour(svtx)
+        return removed_vtx
+
+    def _restore_strings(self, vtx, captured_vtx):
+        # The move stone is taken back and the captured stones are put back
+        # on the state. Rebuild the strings around the changed vertices.
+        self.parent[vtx] = self.num_vertices
+        seeds = list(captured_vtx)
+        for cvtx in [vtx] + captured_vtx:
+            for d in self.dir4:
+                nvtx = cvtx + d
+                if self.state[nvtx] in [self.BLACK, self.WHITE]:
+                    seeds.append(nvtx)
+        rebuilt = set()
+        for svtx in seeds:
+            if not svtx in rebuilt:
+                rebuilt.update(self._rebuild_string(svtx))
+
+    def _setup_strings(self):
+        # Build the strings of the stones which were put on the state
+        # directly.
+        for color in [self.BLACK, self.WHITE]:
+            for vtx in self.get_stones(color):
+                if self.parent[vtx] == self.num_vertices:
+                    self._rebuild_string(vtx)
+
+    def _rebuild_string(self, vtx):
+        # Search the whole string from the vertex and reset its string data.
+        color = self.state[vtx]
+        string_vtx = [vtx]
+        visited = {vtx}
+        liberties = set()
+        idx = 0
+        while idx < len(string_vtx):
+            pos = string_vtx[idx]
+            idx += 1
             for d in self.dir4:
-                svtx = nvtx + d
-                if self.state[svtx] == color and not svtx in string_vtx:
-                    que.append(svtx)
-                    string_vtx.add(svtx)
-                elif self.state[svtx] == self.EMPTY:
-                    surround_vtx.add(svtx)
-        return string_vtx, surround_vtx
+                nvtx = pos + d
+                if self.state[nvtx] == color and not nvtx in visited:
+                    visited.add(nvtx)
+                    string_vtx.append(nvtx)
+                elif self.state[nvtx] == self.EMPTY:
+                    liberties.add(nvtx)
+        for i in range(len(string_vtx)):
+            self.parent[string_vtx[i]] = vtx
+            self.next_stone[string_vtx[i-1]] = string_vtx[i]
+        self.string_size[vtx] = len(string_vtx)
+        self.libs[vtx] = len(liberties)
+        return string_vtx
+
+    def _get_string_stones(self, vtx):
+        string_vtx = list()
+        if not self.state[vtx] in [self.BLACK, self.WHITE]:
+            return string_vtx
+
+        pos = vtx
+        while True:
+            string_vtx.append(pos)
+            pos = self.next_stone[pos]
+            if pos == vtx:
+                break
+        return string_vtx
 
     def _get_fancy_scoring_rule(self, scoring):
         if isinstance(scoring, int):
@@ -321,6 +759,17 @@ class Board:
             return default
         raise Exception("Scoring should be int/str.")
 
+    def _get_fancy_superko_rule(self, superko):
+        if isinstance(superko, int):
+            return superko
+        elif isinstance(superko, str):
+            if superko.lower() in ["positional", "psk"]:
+                return self.SUPERKO_POSITIONAL
+            elif superko.lower() in ["situational", "ssk"]:
+                return self.SUPERKO_SITUATIONAL
+            return self.SUPERKO_NONE
+        raise Exception("Superko rule should be int/str.")
+
     def _get_fancy_color(self, color):
         if color is None or \
                isinstance(color, int):
@@ -348,6 +797,59 @@ class Board:
                 return self.get_vertex(x, y)
         raise Exception("Vertex coordinate should be int/tuple/GtpVertex.")
 
+    def to_bytes(self):
+        # Compact binary encoding of the position. Every intersection takes
+        # 2 bits in the row-major order. The dead marks, the move number and
+        # the history are not part of the position.
+        ko = self.ko[self.to_move]
+        ko_idx = self.SERIAL_NULL_INDEX
+        if ko != self.NULL_VERTEX:
+            ko_idx = self.get_index(*self.vertex_to_xy(ko))
+
+        header = self.SERIAL_HEADER.pack(
+            self.SERIAL_VERSION, self.board_size, self.to_move,
+            self.scoring_rule, min(self.num_passes, 255), ko_idx,
+            self.prisoners[self.BLACK], self.prisoners[self.WHITE],
+            self.komi)
+
+        packed = bytearray((self.num_intersections + 3) // 4)
+        for color in [self.BLACK, self.WHITE]:
+            for vtx in self.get_stones(color):
+                idx = self.get_index(*self.vertex_to_xy(vtx))
+                packed[idx >> 2] |= (color + 1) << ((idx & 3) << 1)
+        return header + bytes(packed)
+
+    @classmethod
+    def from_bytes(cls, data):
+        version, board_size, to_move, scoring_rule, num_passes, ko_idx, \
+            black_prisoners, white_prisoners, komi = \
+            cls.SERIAL_HEADER.unpack_from(data)
+        if version != cls.SERIAL_VERSION:
+            raise Exception("Unknown board encoding version.")
+
+        board = cls(board_size, komi, scoring_rule)
+        packed = data[cls.SERIAL_HEADER.size:]
+        if len(packed) != (board.num_intersections + 3) // 4:
+            raise Exception("The board encoding is broken.")
+
+        for idx in range(board.num_intersections):
+            code = (packed[idx >> 2] >> ((idx & 3) << 1)) & 3
+            if code == 0:
+                continue
+            color = code - 1
+            vtx = board.index_to_vertex(idx)
+            board.state[vtx] = color
+            board.stone_bits[color] |= 1 << vtx
+            board.position_key ^= Zobrist.STONE[color][vtx]
+        board._setup_strings()
+
+        board.to_move = to_move
+        board.num_passes = num_passes
+        board.prisoners = [black_prisoners, white_prisoners]
+        if ko_idx != cls.SERIAL_NULL_INDEX:
+            board.ko[to_move] = board.index_to_vertex(ko_idx)
+        return board
+
     def get_gtp_color(self, color):
         return GtpColor(["b", "w"][self._get_fancy_color(color)])
 
@@ -359,15 +861,16 @@ class Board:
             return GtpVertex(GtpVertex.RESIGN_VERTEX)
         return GtpVertex(self.vertex_to_xy(vtx))
 
-    def transform_scoring_rule(self, scoring):
+    @classmethod
+    def transform_scoring_rule(cls, scoring):
         if isinstance(scoring, int):
             return ["chinese", "japanese"][scoring]
         elif isinstance(scoring, str):
-            default = self.SCORING_AREA
+            default = cls.SCORING_AREA
             if scoring.lower() in ["chinese", "area", "cn"]:
-                return self.SCORING_AREA
+                return cls.SCORING_AREA
             elif scoring.lower() in ["japanese", "territory", "jp"]:
-                return self.SCORING_TERRITORY
+                return cls.SCORING_TERRITORY
             return default
         raise Exception("Scoring should be int/str.")
 
@@ -387,7 +890,7 @@ class Board:
         return idx % self.board_size, idx // self.board_size
 
     def __hash__(self):
-        return hash(str(self))
+        return self.hash_key
 
     def __str__(self):
         def get_xlabel(bsize, x_labels):
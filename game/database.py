@@ -0,0 +1,413 @@
+from .board import Board
+from .tree import Tree, NodeKey
+from .gtp import GtpColor, GtpVertex
+from . import sgf_parser
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter
+from array import array
+import argparse
+import bisect
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+# The store file is
+#     header | packed moves of every game | index
+# The index is the JSON list of the game information, and each game keeps
+# the offset and the number of its moves. The header gives the offset of
+# the index, so the moves are never read until a game is opened.
+STORE_MAGIC = b"SGDB"
+STORE_VERSION = 1
+STORE_HEADER = struct.Struct("<4sBIQ") # magic, version, games, index offset
+
+# A move is packed into 16 bits, the color in the highest bit and the
+# row-major index of the vertex in the others.
+PACKED_PASS = 0x7fff
+PACKED_COLOR_SHIFT = 15
+
+# The game information kept from the root properties.
+INFO_PROPERTIES = {
+    "PB" : "black",
+    "PW" : "white",
+    "RE" : "result",
+    "DT" : "date",
+    "EV" : "event"
+}
+
+def unpack_move(packed, board_size):
+    color = GtpColor("w" if packed >> PACKED_COLOR_SHIFT else "b")
+    idx = packed & PACKED_PASS
+    if idx == PACKED_PASS:
+        return color, GtpVertex(GtpVertex.PASS_VERTEX)
+    return color, GtpVertex((idx % board_size, idx // board_size))
+
+def _parse_game(path):
+    # Run in the worker process. The main line is the text before the first
+    # closed variation, so the tokens are read until there and no tree is
+    # built. The moves are not played, so the illegal ones are found when
+    # the game is opened, by load_board() or when the board of the node of
+    # load_tree() is built.
+    properties = dict()
+    sgf_moves = list()
+    try:
+        with open(path, "r") as f:
+            for token in sgf_parser.SgfTokenizer(f):
+                if token == ')':
+                    break
+                if isinstance(token, str):
+                    continue
+                key, values = token
+                if key == "B" or key == "W":
+                    sgf_moves.append((key, values[0]))
+                elif key == "AB" or key == "AW":
+                    return None
+                elif not key in properties:
+                    properties[key] = values
+        board_size = int(properties.get("SZ", [ 19 ])[0])
+        komi = float(properties.get("KM", [ 7.5 ])[0])
+        rule = Board.transform_scoring_rule(properties.get("RU", [ "chinese" ])[0])
+        if board_size * board_size >= PACKED_PASS:
+            return None
+
+        # A broken vertex fails the whole file, rather than being stored
+        # as another point.
+        moves = array("H")
+        for key, m in sgf_moves:
+            color = int(key == "W") << PACKED_COLOR_SHIFT
+            if len(m) == 0 or m == "tt":
+                moves.append(color | PACKED_PASS)
+                continue
+            if len(m) != 2:
+                return None
+            x = ord(m[0]) - ord('a')
+            y = board_size - 1 - (ord(m[1]) - ord('a'))
+            if x < 0 or x >= board_size or y < 0 or y >= board_size:
+                return None
+            moves.append(color | (y * board_size + x))
+    except Exception:
+        return None
+
+    if sys.byteorder != "little":
+        moves.byteswap()
+
+    info = {
+        "path" : path,
+        "size" : board_size,
+        "komi" : komi,
+        "rule" : ["chinese", "japanese"][rule]
+    }
+    for key, name in INFO_PROPERTIES.items():
+        if key in properties:
+            info[name] = properties[key][0]
+    return info, moves.tobytes()
+
+def find_sgf_files(root):
+    if os.path.isfile(root):
+        return [ root ]
+    paths = list()
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if name.lower().endswith(".sgf"):
+                paths.append(os.path.join(dirpath, name))
+    paths.sort()
+    return paths
+
+def ingest(sources, store_path, workers=None, chunksize=64):
+    # Parse all SGF files of the sources (files or directories) in a process
+    # pool and write them into one store file. The results come back in
+    # order and are written at once, so the parent keeps only the index.
+    # Return the number of the stored games and the failed files.
+    if isinstance(sources, str):
+        sources = [ sources ]
+    paths = list()
+    for source in sources:
+        paths.extend(find_sgf_files(source))
+
+    index = list()
+    failed = list()
+    with open(store_path, "wb") as f:
+        f.write(STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION, 0, 0))
+        offset = STORE_HEADER.size
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for path, result in zip(paths, executor.map(_parse_game, paths, chunksize=chunksize)):
+                if result is None:
+                    failed.append(path)
+                    continue
+                info, data = result
+                info["offset"] = offset
+                info["moves"] = len(data) // 2
+                f.write(data)
+                offset += len(data)
+                index.append(info)
+
+        f.write(json.dumps(index).encode("utf-8"))
+        f.seek(0)
+        f.write(STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION, len(index), offset))
+    return len(index), failed
+
+class GameStore:
+    # Read the store file written by ingest(). Opening it reads the index
+    # only, and every game is read by one seek.
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "rb")
+        magic, version, num_games, index_offset = \
+            STORE_HEADER.unpack(self.f.read(STORE_HEADER.size))
+        if magic != STORE_MAGIC or version != STORE_VERSION:
+            self.f.close()
+            raise Exception("Not a game store file.")
+        self.f.seek(index_offset)
+        self.index = json.loads(self.f.read().decode("utf-8"))
+        if len(self.index) != num_games:
+            self.f.close()
+            raise Exception("The game store file is broken.")
+
+    def __len__(self):
+        return len(self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.f.close()
+
+    def get_info(self, game_id):
+        return self.index[game_id]
+
+    def find(self, **kwargs):
+        # Return the ids of the games whose information contains all of
+        # the given values, such as find(black="Lee", size=19).
+        result = list()
+        for game_id, info in enumerate(self.index):
+            matched = True
+            for key, val in kwargs.items():
+                curr = info.get(key)
+                if isinstance(val, str):
+                    matched = isinstance(curr, str) and val in curr
+                else:
+                    matched = curr == val
+                if not matched:
+                    break
+            if matched:
+                result.append(game_id)
+        return result
+
+    def get_packed_moves(self, game_id):
+        info = self.index[game_id]
+        self.f.seek(info["offset"])
+        moves = array("H")
+        moves.frombytes(self.f.read(2 * info["moves"]))
+        if sys.byteorder != "little":
+            moves.byteswap()
+        return moves
+
+    def get_moves(self, game_id):
+        size = self.index[game_id]["size"]
+        return [ unpack_move(m, size) for m in self.get_packed_moves(game_id) ]
+
+    def get_empty_board(self, game_id):
+        info = self.index[game_id]
+        return Board(info["size"], info["komi"], info["rule"])
+
+    def load_board(self, game_id, num_moves=None):
+        # The board after the given number of moves, or the final one.
+        board = self.get_empty_board(game_id)
+        moves = self.get_moves(game_id)
+        if not num_moves is None:
+            moves = moves[:num_moves]
+        board.play_sequence(
+            [ vtx for _, vtx in moves ], [ col for col, _ in moves ])
+        return board
+
+    def load_tree(self, game_id, checkpoint_interval=None):
+        # The main line as a tree. Like the lazy SGF loading, the boards are
+        # built when they are visited.
+        tree = Tree({ "board" : self.get_empty_board(game_id) }, checkpoint_interval)
+        for col, vtx in self.get_moves(game_id):
+            tree.add_and_forward(NodeKey(col, vtx), dict())
+        return tree
+
+# The position index file is
+#     header | sorted hashes | references
+# Both arrays are 64-bit and have one entry for every position of every
+# game in the store, the position before each move and the final one. A
+# reference packs the game id, the move number and the next move.
+INDEX_MAGIC = b"SGPI"
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct("<4sBBxxQ") # magic, version, little endian, entries
+INDEX_BUCKET_BITS = 8
+
+REF_GAME_SHIFT = 33
+REF_MOVE_SHIFT = 17
+REF_HAS_NEXT = 1 << 16
+
+def _index_games(args):
+    # Run in the worker process. Replay the games and split the entries
+    # into buckets by the highest bits of the hash, so the parent only
+    # sorts one bucket at a time.
+    store_path, start, stop = args
+    num_buckets = 1 << INDEX_BUCKET_BITS
+    shift = 64 - INDEX_BUCKET_BITS
+    keys = [ array("Q") for _ in range(num_buckets) ]
+    refs = [ array("Q") for _ in range(num_buckets) ]
+    with GameStore(store_path) as store:
+        for game_id in range(start, stop):
+            board = store.get_empty_board(game_id)
+            size = board.board_size
+            moves = store.get_packed_moves(game_id)
+            for move_number in range(len(moves) + 1):
+                key = board.hash_key
+                ref = (game_id << REF_GAME_SHIFT) | (move_number << REF_MOVE_SHIFT)
+                if move_number < len(moves):
+                    ref |= REF_HAS_NEXT | moves[move_number]
+                keys[key >> shift].append(key)
+                refs[key >> shift].append(ref)
+                if move_number == len(moves):
+                    break
+
+                packed = moves[move_number]
+                color = packed >> PACKED_COLOR_SHIFT
+                idx = packed & PACKED_PASS
+                if idx == PACKED_PASS:
+                    vtx = board.PASS_VERTEX
+                else:
+                    vtx = board.get_vertex(idx % size, idx // size)
+                try:
+                    board.play(vtx, color)
+                except Exception:
+                    # Stop at the illegal move. The positions before it
+                    # are still indexed.
+                    break
+    return [ k.tobytes() for k in keys ], [ r.tobytes() for r in refs ]
+
+def build_position_index(store_path, index_path, workers=None, games_per_task=256):
+    # Return the number of the indexed positions.
+    with GameStore(store_path) as store:
+        num_games = len(store)
+    num_buckets = 1 << INDEX_BUCKET_BITS
+    tasks = [ (store_path, start, min(start + games_per_task, num_games))
+                  for start in range(0, num_games, games_per_task) ]
+
+    # The results of the tasks are spilled into one temporary file, and
+    # the chunks of every bucket are remembered as (offset, entries), so
+    # only one file is open however many buckets there are.
+    chunks = [ list() for _ in range(num_buckets) ]
+    num_entries = 0
+    with tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(index_path))) as spill:
+        offset = 0
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for keys, refs in executor.map(_index_games, tasks):
+                for b in range(num_buckets):
+                    if len(keys[b]) == 0:
+                        continue
+                    spill.write(keys[b])
+                    spill.write(refs[b])
+                    chunks[b].append((offset, len(keys[b]) // 8))
+                    offset += len(keys[b]) + len(refs[b])
+                    num_entries += len(keys[b]) // 8
+
+        with open(index_path, "wb") as f:
+            f.write(INDEX_HEADER.pack(
+                INDEX_MAGIC, INDEX_VERSION, int(sys.byteorder == "little"), num_entries))
+            key_offset = INDEX_HEADER.size
+            ref_offset = key_offset + 8 * num_entries
+            for b in range(num_buckets):
+                keys, refs = array("Q"), array("Q")
+                for chunk_offset, count in chunks[b]:
+                    spill.seek(chunk_offset)
+                    keys.frombytes(spill.read(8 * count))
+                    refs.frombytes(spill.read(8 * count))
+                order = sorted(range(len(keys)), key=keys.__getitem__)
+                f.seek(key_offset)
+                f.write(array("Q", [ keys[i] for i in order ]).tobytes())
+                f.seek(ref_offset)
+                f.write(array("Q", [ refs[i] for i in order ]).tobytes())
+                key_offset += 8 * len(keys)
+                ref_offset += 8 * len(refs)
+    return num_entries
+
+class PositionIndex:
+    # Look up the positions by the board hash. The file is memory-mapped, and
+    # a query is a binary search on the sorted hashes.
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "rb")
+        magic, version, little, num_entries = \
+            INDEX_HEADER.unpack(self.f.read(INDEX_HEADER.size))
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            self.f.close()
+            raise Exception("Not a position index file.")
+        if bool(little) != (sys.byteorder == "little"):
+            self.f.close()
+            raise Exception("The position index file is of the other byte order.")
+
+        self.num_entries = num_entries
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        begin = INDEX_HEADER.size
+        end = begin + 8 * num_entries
+        self.keys = memoryview(self.mm)[begin:end].cast("Q")
+        self.refs = memoryview(self.mm)[end:end + 8 * num_entries].cast("Q")
+
+    def __len__(self):
+        return self.num_entries
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.keys.release()
+        self.refs.release()
+        self.mm.close()
+        self.f.close()
+
+    def query(self, board, max_games=None):
+        # Return the games which reach the position of the board, as
+        # (game id, move number), and the next moves with their counts,
+        # the most played first.
+        key = board.hash_key
+        lo = bisect.bisect_left(self.keys, key)
+        hi = bisect.bisect_right(self.keys, key, lo)
+        refs = self.refs[lo:hi]
+
+        if max_games is None:
+            max_games = hi - lo
+        games = [ (ref >> REF_GAME_SHIFT, (ref >> REF_MOVE_SHIFT) & 0xffff)
+                      for ref in refs[:max_games] ]
+        counter = Counter(ref & 0x1ffff for ref in refs)
+        continuations = list()
+        for packed, count in counter.most_common():
+            if packed & REF_HAS_NEXT:
+                col, vtx = unpack_move(packed & 0xffff, board.board_size)
+                continuations.append((col, vtx, count))
+        return {
+            "count" : hi - lo,
+            "games" : games,
+            "continuations" : continuations
+        }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Build the game store and the position index.")
+    parser.add_argument("store", help="the game store file")
+    parser.add_argument("sgf", nargs="*", help="the SGF files or directories to ingest")
+    parser.add_argument("--index", default=None, help="build the position index file")
+    parser.add_argument("--workers", type=int, default=None, help="the number of processes")
+    args = parser.parse_args()
+
+    if len(args.sgf) > 0:
+        num_games, failed = ingest(args.sgf, args.store, args.workers)
+        print("Stored {} games.".format(num_games))
+        for path in failed:
+            sys.stderr.write("Failed to load {}.\n".format(path))
+    if not args.index is None:
+        num_entries = build_position_index(args.store, args.index, args.workers)
+        print("Indexed {} positions.".format(num_entries))
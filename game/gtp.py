@@ -1,5 +1,8 @@
 import subprocess
 import threading
+import asyncio
+import concurrent.futures
+import itertools
 import queue
 import sys
 import time
@@ -152,18 +155,43 @@ class GtpVertex:
     def __str__(self):
         return self.to_str()
 
+def _parse_gtp_header(line):
+    # Split the first line of a response, "=[id] ..." or "?[id] ...", into
+    # the result, the id and the rest. Return None if it is not a header.
+    head = line.split()[0]
+    if not head[0] in ["=", "?"]:
+        return None
+    if len(head) == 1:
+        return head, None, line[1:].strip()
+    if not head[1:].isdigit():
+        return None
+    return head[0], int(head[1:]), line[len(head):].strip()
+
+def _is_analysis_command(main_command):
+    return len(main_command.split("-")) <= 2 and \
+               main_command.split("-")[-1] in ["analyze", "genmove_analyze"]
+
 class Query:
+    # The id is sent with the command, and the engine echoes it in the
+    # response, so the responses are matched by it rather than by order.
+    # The future is done when the whole response is received.
+    _id_counter = itertools.count(1)
+
     def __init__(self, gtp_command):
-        self.gtp_command = gtp_command
+        self.id = next(self._id_counter)
+        self.gtp_command = "{} {}".format(self.id, gtp_command)
         self.result = None # = or ?
         self.response = list()
+        self.future = concurrent.futures.Future()
 
     def get_response(self):
         return self.response
 
     def get_main_command(self):
         buf = self.gtp_command.strip().split()
-        if buf is not None:
+        if len(buf) > 0 and buf[0].isdigit():
+            buf = buf[1:]
+        if len(buf) > 0:
             return buf[0]
         return None
 
@@ -186,9 +214,12 @@ class GTPEnginePipe:
             text=True
         )
 
+        # The queries are pushed by the GUI thread and finished by the
+        # handling thread, so the counter is guarded by the lock.
         self._remaining = 0
+        self._lock = threading.Lock()
+        self._pending = dict()
         self._query_queue = queue.Queue()
-        self._wait_queue = queue.Queue()
         self._finish_queue = queue.Queue()
         self._analysis_queue = queue.Queue()
 
@@ -210,7 +241,8 @@ class GTPEnginePipe:
         return [self._send_query_thread, self._handle_gtp_thread, self._read_err_thread]
 
     def get_remaining_queries(self):
-        return self._remaining
+        with self._lock:
+            return self._remaining
 
     def is_running(self):
         return self._running
@@ -222,17 +254,22 @@ class GTPEnginePipe:
         return self._analysis_queue.empty()
 
     def push_query(self, query):
-        try:
-            self._query_queue.put(query)
-            self._remaining += 1
-        except queue.Full:
-            pass
+        self.push_queries([ query ])
+
+    def push_queries(self, queries):
+        # The queries are written in one batch, and each of them is still
+        # finished on its own.
+        with self._lock:
+            self._remaining += len(queries)
+        self._query_queue.put(queries)
 
     def push_gtp_command(self, cmd):
-        query = Query(
-            gtp_command="{}\n".format(cmd.strip())
-        )
-        self.push_query(query)
+        return self.push_gtp_commands([ cmd ])[0]
+
+    def push_gtp_commands(self, cmds):
+        queries = [ Query(gtp_command="{}\n".format(cmd.strip())) for cmd in cmds ]
+        self.push_queries(queries)
+        return queries
 
     def _read_err_loop(self):
         while self._running:
@@ -246,66 +283,107 @@ class GTPEnginePipe:
     def _send_query_loop(self):
         while self._running:
             try:
-                query = self._query_queue.get(block=True, timeout=0.1)
+                queries = self._query_queue.get(block=True, timeout=0.1)
             except queue.Empty:
                 continue
 
-            cmd = query.gtp_command
+            # Register the queries before writing them, so the response
+            # can not come first.
+            with self._lock:
+                for query in queries:
+                    self._pending[query.id] = query
 
             try:
-                self._engine.stdin.write(cmd)
+                self._engine.stdin.write("".join(q.gtp_command for q in queries))
                 self._engine.stdin.flush()
-                self._wait_queue.put(query)
             except OSError as e:
                 break
 
+    def _take_pending(self, query_id):
+        # The response without id belongs to the oldest query.
+        with self._lock:
+            if query_id is None:
+                if len(self._pending) == 0:
+                    return None
+                query_id = next(iter(self._pending))
+            return self._pending.pop(query_id, None)
+
+    def _finish_query(self, query):
+        self._finish_queue.put(query)
+        query.future.set_result(query)
+
     def _handle_gtp_loop(self):
         handling_query = None
         receiving_analysis = False
+        skipping = False
         while self._running:
-            if handling_query is None:
-                try:
-                    query = self._wait_queue.get(block=True, timeout=0.1)
-                    handling_query = query
-
-                    main_command = handling_query.get_main_command()
-                    if len(main_command.split("-")) <= 2 and \
-                           main_command.split("-")[-1] in ["analyze", "genmove_analyze"]:
-                        receiving_analysis = True
-                except queue.Empty:
-                    continue
-
             try:
-                line = self._engine.stdout.readline().strip()
+                line = self._engine.stdout.readline()
             except OSError as e:
                 break
+            if not line:
+                # The engine is closed.
+                break
+            line = line.strip()
+
+            if handling_query is None and not skipping:
+                if not line:
+                    continue
+                header = _parse_gtp_header(line)
+                if header is None:
+                    continue
+                result, query_id, line = header
+                handling_query = self._take_pending(query_id)
+                if handling_query is None:
+                    # The response of an unknown query.
+                    skipping = True
+                    continue
+                handling_query.result = result
+                receiving_analysis = _is_analysis_command(
+                                         handling_query.get_main_command())
+                self._append_line(handling_query, line, receiving_analysis)
+                continue
 
             if not line:
+                if skipping:
+                    skipping = False
+                    continue
                 if receiving_analysis:
-                    self._analysis_queue.put({"type" : "end", "data" : None})
+                    self._analysis_queue.put(
+                        {"type" : "end", "data" : None, "id" : handling_query.id})
                     receiving_analysis = False
-                self._finish_queue.put(handling_query)
+                self._finish_query(handling_query)
                 handling_query = None
                 continue
-
-            if line.split()[0] in ["=", "?"] and \
-                   handling_query.result is None:
-                handling_query.result = line.split()[0]
-                line = line[1:].strip()
-
-            if receiving_analysis and len(line) > 0:
-                analysis_out = {"type" : "info", "data" : line}
-                if "play" in line:
-                    analysis_out["type"] = "play"
-                self._analysis_queue.put(analysis_out)
-            handling_query.response.append(line)
+            if skipping:
+                continue
+            self._append_line(handling_query, line, receiving_analysis)
+
+        # The engine is closed, so the waiting queries are never answered.
+        with self._lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        if not handling_query is None:
+            pending.append(handling_query)
+        for query in pending:
+            if not query.future.done():
+                query.future.set_exception(Exception("Engine is stop."))
+
+    def _append_line(self, query, line, receiving_analysis):
+        if receiving_analysis and len(line) > 0:
+            analysis_out = {"type" : "info", "data" : line, "id" : query.id}
+            if "play" in line:
+                analysis_out["type"] = "play"
+            self._analysis_queue.put(analysis_out)
+        query.response.append(line)
 
     def try_get_query(self, block=False):
         try:
             query = self._finish_queue.get(block=block, timeout=9999)
         except queue.Empty:
             return None
-        self._remaining -= 1
+        with self._lock:
+            self._remaining -= 1
         return query
 
     def try_get_response(self, block=False):
@@ -342,6 +420,195 @@ class GTPEnginePipe:
         for t in self._gather_threads():
             t.join()
 
+class AsyncGTPEnginePipe:
+    # The engine pipe on asyncio. The streams are read by tasks of the event
+    # loop instead of threads, so the responses are handled as soon as they
+    # arrive and many engines can share one thread.
+    #
+    #     pipe = await AsyncGTPEnginePipe.create("sayuri ...")
+    #     query = await pipe.send_command("name")
+    def __init__(self, command):
+        self.command = command
+        self._engine = None
+        self._tasks = list()
+        self._pending = dict()
+        self._analysis_queue = asyncio.Queue()
+        self._running = False
+
+    @classmethod
+    async def create(cls, command):
+        pipe = cls(command)
+        await pipe.start()
+        return pipe
+
+    async def start(self):
+        self._engine = await asyncio.create_subprocess_exec(
+            *self.command.split(),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        self._running = True
+        self._tasks = [
+            asyncio.ensure_future(self._handle_gtp_loop()),
+            asyncio.ensure_future(self._read_err_loop())
+        ]
+
+    def is_running(self):
+        return self._running
+
+    def get_remaining_queries(self):
+        return len(self._pending)
+
+    def push_query(self, query):
+        # Return the future of the query, which is done when the whole
+        # response is received. The responses are matched by the query id.
+        future = asyncio.get_running_loop().create_future()
+        if not self._running:
+            future.set_exception(Exception("Engine is stop."))
+            return future
+        self._pending[query.id] = (query, future)
+        self._engine.stdin.write(query.gtp_command.encode())
+        return future
+
+    def push_gtp_command(self, cmd):
+        query = Query(
+            gtp_command="{}\n".format(cmd.strip())
+        )
+        return self.push_query(query)
+
+    def push_gtp_commands(self, cmds):
+        return [ self.push_gtp_command(cmd) for cmd in cmds ]
+
+    async def send_command(self, cmd):
+        future = self.push_gtp_command(cmd)
+        await self._engine.stdin.drain()
+        return await future
+
+    async def get_analysis(self):
+        return await self._analysis_queue.get()
+
+    async def analysis_lines(self):
+        # Iterate the lines of the current analysis until it ends. Raise if
+        # the engine exits first.
+        while True:
+            line = await self._analysis_queue.get()
+            if line["type"] == "stop":
+                # Keep the mark for the other readers.
+                self._analysis_queue.put_nowait(line)
+                raise Exception("Engine is stop.")
+            if line["type"] == "end":
+                return
+            yield line
+
+    async def _read_err_loop(self):
+        while self._running:
+            line = await self._engine.stderr.readline()
+            if not line:
+                break
+            sys.stderr.write(line.decode(errors="replace"))
+            sys.stderr.flush()
+
+    def _take_pending(self, query_id):
+        # The response without id belongs to the oldest query.
+        if query_id is None:
+            if len(self._pending) == 0:
+                return None, None
+            query_id = next(iter(self._pending))
+        return self._pending.pop(query_id, (None, None))
+
+    async def _handle_gtp_loop(self):
+        handling_query = None
+        handling_future = None
+        receiving_analysis = False
+        skipping = False
+        while self._running:
+            line = await self._engine.stdout.readline()
+            if not line:
+                # The engine is closed.
+                break
+            line = line.decode(errors="replace").strip()
+
+            if handling_query is None and not skipping:
+                if not line:
+                    continue
+                header = _parse_gtp_header(line)
+                if header is None:
+                    continue
+                result, query_id, line = header
+                handling_query, handling_future = self._take_pending(query_id)
+                if handling_query is None:
+                    # The response of an unknown query.
+                    skipping = True
+                    continue
+                handling_query.result = result
+                receiving_analysis = _is_analysis_command(
+                                         handling_query.get_main_command())
+                self._append_line(handling_query, line, receiving_analysis)
+                continue
+
+            if not line:
+                if skipping:
+                    skipping = False
+                    continue
+                if receiving_analysis:
+                    self._analysis_queue.put_nowait(
+                        {"type" : "end", "data" : None, "id" : handling_query.id})
+                    receiving_analysis = False
+                handling_query.future.set_result(handling_query)
+                if not handling_future.done():
+                    handling_future.set_result(handling_query)
+                handling_query = None
+                continue
+            if skipping:
+                continue
+            self._append_line(handling_query, line, receiving_analysis)
+
+        # The engine is closed, so the waiting queries are never answered.
+        # The stop mark ends the readers of the analysis.
+        self._running = False
+        pending = list(self._pending.values())
+        self._pending.clear()
+        if not handling_query is None:
+            pending.append((handling_query, handling_future))
+        for query, future in pending:
+            if not query.future.done():
+                query.future.set_exception(Exception("Engine is stop."))
+            if not future.done():
+                future.set_exception(Exception("Engine is stop."))
+        self._analysis_queue.put_nowait({"type" : "stop", "data" : None, "id" : None})
+
+    def _append_line(self, query, line, receiving_analysis):
+        if receiving_analysis and len(line) > 0:
+            analysis_out = {"type" : "info", "data" : line, "id" : query.id}
+            if "play" in line:
+                analysis_out["type"] = "play"
+            self._analysis_queue.put_nowait(analysis_out)
+        query.response.append(line)
+
+    def alive(self):
+        return not self._engine is None and \
+                   self._engine.returncode is None
+
+    async def wait(self):
+        return await self._engine.wait()
+
+    def kill(self):
+        self._engine.kill()
+
+    async def close(self):
+        # Send quit and wait for the engine to exit.
+        if self._running:
+            try:
+                await self.send_command("quit")
+            except Exception:
+                pass
+        await self._engine.wait()
+        self._running = False
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
 class GtpEngineBase:
     def __init__(self, command):
         self.command = command
@@ -355,16 +622,16 @@ class GtpEngineBase:
         self.shutdown()
 
     def _get_supported_commands(self):
-        self._send_base("list_commands")
-
-        while not self.query_empty():
-            self.idle(0.1)
-        res, val = self.get_last_response_raw()
+        # Wait on the query itself. It raises if the engine exits before
+        # answering, e.g. the weights can not be loaded.
+        query = self._send_base("list_commands")
+        query.future.result()
+        self.get_last_query()
 
-        if res == "=":
-            self._supported_list = val.strip().split()
+        if query.result == "=":
+            self._supported_list = str(query).strip().split()
 
-    def _send_base(self, gtp_command):
+    def _check_command(self, gtp_command):
         if not self._pipe.is_running():
             raise Exception("Engine is stop.")
 
@@ -378,7 +645,9 @@ class GtpEngineBase:
         if cmd_list[0] not in self._supported_list:
             raise Exception("Current command is not supported.")
 
-        self._pipe.push_gtp_command(gtp_command)
+    def _send_base(self, gtp_command):
+        self._check_command(gtp_command)
+        return self._pipe.push_gtp_command(gtp_command)
 
     def idle(self, sec=1.0):
         # The queue/pipe may not update their status right now. Should
@@ -386,12 +655,25 @@ class GtpEngineBase:
         time.sleep(sec)
 
     def send_command(self, val):
+        # Return the query, whose future is done with the response, or
+        # False if the command can not be sent.
         try:
-            self._send_base(val)
+            query = self._send_base(val)
         except Exception as err:
             sys.stderr.write("{}\n".format(str(err)))
             return False
-        return True
+        return query
+
+    def send_commands(self, vals):
+        # Send the commands in one batch. The unsupported ones are skipped.
+        cmds = list()
+        for val in vals:
+            try:
+                self._check_command(val)
+                cmds.append(val)
+            except Exception as err:
+                sys.stderr.write("{}\n".format(str(err)))
+        return self._pipe.push_gtp_commands(cmds)
 
     def support(self, val):
         return val in self._supported_list
@@ -0,0 +1,351 @@
+from .database import GameStore, PACKED_PASS, PACKED_COLOR_SHIFT
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+import argparse
+import mmap
+import struct
+import sys
+
+# The pattern search works on the four corner regions of the board. Every
+# region is mirrored into the frame of the top-left corner, and its stones
+# are kept as two 64-bit masks (8x8 points, bit = row * 8 + col, where the
+# row counts from the edge of the corner). The other symmetries of a
+# pattern are its transpose, so a query only tries the pattern and its
+# transpose, with both colors, against the corner frames.
+PATTERN_SIZE = 8
+NUM_CORNERS = 4
+
+# The pattern index file is
+#     header | states | table | bit sets
+# The table has (offset, count, black union, white union) for every corner
+# of every game, and the states are (move number, black, white) for every
+# change of the corner. The bit sets are the inverted index of the unions.
+# There is one for every color and point of the corner frame, and its bit i
+# is set if the union of the corner i has the stone. So the corners which
+# may have a pattern are found with a few big integer ANDs, and only their
+# states are read.
+PATTERN_MAGIC = b"SGPT"
+PATTERN_VERSION = 2
+PATTERN_HEADER = struct.Struct("<4sBBxxQQ") # magic, version, little endian, games, states
+TABLE_FIELDS = 4
+STATE_FIELDS = 3
+NUM_POINTS = PATTERN_SIZE * PATTERN_SIZE
+
+def _get_corner_bits(board_size):
+    # The (corner, bit) of every vertex of the board, in the row-major
+    # order.
+    region = min(PATTERN_SIZE, board_size)
+    corner_bits = list()
+    for y in range(board_size):
+        for x in range(board_size):
+            bits = list()
+            top, left = board_size - 1 - y, x
+            bottom, right = y, board_size - 1 - x
+            for corner, (row, col) in enumerate([
+                    (top, left), (top, right), (bottom, left), (bottom, right) ]):
+                if row < region and col < region:
+                    bits.append((corner, 1 << (row * PATTERN_SIZE + col)))
+            corner_bits.append(bits)
+    return corner_bits
+
+def _scan_games(args):
+    # Run in the worker process. Replay the games, and record the corner
+    # masks every time they change.
+    store_path, start, stop = args
+    table = array("Q")
+    states = array("Q")
+    corner_bits_cache = dict()
+    with GameStore(store_path) as store:
+        for game_id in range(start, stop):
+            board = store.get_empty_board(game_id)
+            size = board.board_size
+            corner_bits = corner_bits_cache.get(size)
+            if corner_bits is None:
+                corner_bits = _get_corner_bits(size)
+                corner_bits_cache[size] = corner_bits
+
+            masks = [ [0, 0] for _ in range(NUM_CORNERS) ]
+            unions = [ [0, 0] for _ in range(NUM_CORNERS) ]
+            records = [ array("Q") for _ in range(NUM_CORNERS) ]
+            moves = store.get_packed_moves(game_id)
+            for move_number, packed in enumerate(moves, 1):
+                color = packed >> PACKED_COLOR_SHIFT
+                idx = packed & PACKED_PASS
+                if idx == PACKED_PASS:
+                    vtx = board.PASS_VERTEX
+                else:
+                    vtx = board.get_vertex(idx % size, idx // size)
+                version = board.version
+                try:
+                    board.play(vtx, color)
+                except Exception:
+                    # Stop at the illegal move.
+                    break
+                if vtx == board.PASS_VERTEX:
+                    # The pass clears the ko, but the stones are the same.
+                    continue
+
+                changes = board.get_changes_since(version)
+                if changes is None:
+                    changes = [ (x, y) for y in range(size) for x in range(size) ]
+                changed = set()
+                for x, y in changes:
+                    state = board.state[board.get_vertex(x, y)]
+                    for corner, bit in corner_bits[y * size + x]:
+                        mask = masks[corner]
+                        mask[0] &= ~bit
+                        mask[1] &= ~bit
+                        if state == board.BLACK or state == board.WHITE:
+                            mask[state] |= bit
+                        changed.add(corner)
+                for corner in changed:
+                    black, white = masks[corner]
+                    records[corner].extend((move_number, black, white))
+                    unions[corner][0] |= black
+                    unions[corner][1] |= white
+
+            for corner in range(NUM_CORNERS):
+                table.extend((
+                    len(states) // STATE_FIELDS,
+                    len(records[corner]) // STATE_FIELDS,
+                    unions[corner][0],
+                    unions[corner][1]))
+                states.extend(records[corner])
+    return table.tobytes(), states.tobytes(), _get_union_bits(table)
+
+def _get_union_bits(table):
+    # The bit sets of the corners of the table, as the little endian bytes
+    # for every color and point.
+    num_corners = len(table) // TABLE_FIELDS
+    bits = [ [ 0 ] * NUM_POINTS for _ in range(2) ]
+    for i in range(num_corners):
+        for color in range(2):
+            mask = table[i * TABLE_FIELDS + 2 + color]
+            color_bits = bits[color]
+            while mask:
+                low = mask & -mask
+                color_bits[low.bit_length() - 1] |= 1 << i
+                mask ^= low
+    length = (num_corners + 7) // 8
+    return [ b.to_bytes(length, "little") for color_bits in bits for b in color_bits ]
+
+def build_pattern_index(store_path, pattern_path, workers=None, games_per_task=256):
+    # Return the number of the recorded corner states.
+    with GameStore(store_path) as store:
+        num_games = len(store)
+    # The bit sets of the tasks are joined as bytes, so every task but the
+    # last one must have a whole number of bytes of corners.
+    games_per_task += games_per_task % 2
+    tasks = [ (store_path, start, min(start + games_per_task, num_games))
+                  for start in range(0, num_games, games_per_task) ]
+
+    table = array("Q")
+    union_bits = [ list() for _ in range(2 * NUM_POINTS) ]
+    num_states = 0
+    with open(pattern_path, "wb") as f:
+        f.write(PATTERN_HEADER.pack(
+            PATTERN_MAGIC, PATTERN_VERSION, int(sys.byteorder == "little"), 0, 0))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for table_data, states_data, task_bits in executor.map(_scan_games, tasks):
+                for b, data in zip(union_bits, task_bits):
+                    b.append(data)
+                # The states are written at once, and the table is written
+                # after them, with the global offsets.
+                task_table = array("Q")
+                task_table.frombytes(table_data)
+                for i in range(0, len(task_table), TABLE_FIELDS):
+                    task_table[i] += num_states
+                table.extend(task_table)
+                f.write(states_data)
+                num_states += len(states_data) // (8 * STATE_FIELDS)
+        f.write(table.tobytes())
+        for b in union_bits:
+            f.write(b"".join(b))
+        f.seek(0)
+        f.write(PATTERN_HEADER.pack(
+            PATTERN_MAGIC, PATTERN_VERSION, int(sys.byteorder == "little"), num_games, num_states))
+    return num_states
+
+class Pattern:
+    # A local shape in the frame of the top-left corner. The rows are the
+    # strings of 'X' (black), 'O' (white), '.' (empty) and '?' (any), and
+    # the first row is the edge of the board.
+    def __init__(self, rows):
+        self.height = len(rows)
+        self.width = max([ len(r) for r in rows ] + [ 0 ])
+        if self.height > PATTERN_SIZE or self.width > PATTERN_SIZE:
+            raise Exception("The pattern is larger than {}x{}.".format(PATTERN_SIZE, PATTERN_SIZE))
+
+        self.black, self.white, self.empty = 0, 0, 0
+        for row, line in enumerate(rows):
+            for col, c in enumerate(line):
+                bit = 1 << (row * PATTERN_SIZE + col)
+                if c in "Xx":
+                    self.black |= bit
+                elif c in "Oo":
+                    self.white |= bit
+                elif c == '.':
+                    self.empty |= bit
+                elif c != '?':
+                    raise Exception("Invalid pattern character {}.".format(c))
+        if self.black == 0 and self.white == 0:
+            raise Exception("The pattern has no stones.")
+
+    def get_variants(self, anchored=True, swap_colors=True):
+        # The masks of the pattern, its transpose and their color swapped
+        # ones, at every offset of the corner frame if it is not anchored.
+        shapes = [ (self.black, self.white, self.empty, self.width, self.height) ]
+        shapes.append(tuple(
+            [ self._transpose(m) for m in (self.black, self.white, self.empty) ] + [ self.height, self.width ]))
+        if swap_colors:
+            shapes.extend([ (w, b, e, wd, ht) for b, w, e, wd, ht in shapes ])
+
+        variants = list()
+        for black, white, empty, width, height in shapes:
+            if anchored:
+                offsets = [ (0, 0) ]
+            else:
+                offsets = [ (r, c) for r in range(PATTERN_SIZE - height + 1)
+                                       for c in range(PATTERN_SIZE - width + 1) ]
+            for r, c in offsets:
+                shift = r * PATTERN_SIZE + c
+                variant = (black << shift, white << shift, empty << shift)
+                if not variant in variants:
+                    variants.append(variant)
+        return variants
+
+    def _transpose(self, mask):
+        out = 0
+        while mask:
+            low = mask & -mask
+            bit = low.bit_length() - 1
+            row, col = divmod(bit, PATTERN_SIZE)
+            out |= 1 << (col * PATTERN_SIZE + row)
+            mask ^= low
+        return out
+
+class PatternIndex:
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "rb")
+        magic, version, little, num_games, num_states = \
+            PATTERN_HEADER.unpack(self.f.read(PATTERN_HEADER.size))
+        if magic != PATTERN_MAGIC or version != PATTERN_VERSION:
+            self.f.close()
+            raise Exception("Not a pattern index file.")
+        if bool(little) != (sys.byteorder == "little"):
+            self.f.close()
+            raise Exception("The pattern index file is of the other byte order.")
+
+        self.num_games = num_games
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        begin = PATTERN_HEADER.size
+        end = begin + 8 * STATE_FIELDS * num_states
+        self.states = memoryview(self.mm)[begin:end].cast("Q")
+        begin, end = end, end + 8 * TABLE_FIELDS * NUM_CORNERS * num_games
+        table = memoryview(self.mm)[begin:end].cast("Q")
+        self.offsets = table[0::TABLE_FIELDS].tolist()
+        self.counts = table[1::TABLE_FIELDS].tolist()
+        self.black_unions = table[2::TABLE_FIELDS].tolist()
+        self.white_unions = table[3::TABLE_FIELDS].tolist()
+        table.release()
+
+        self.num_corners = NUM_CORNERS * num_games
+        self.bits_length = (self.num_corners + 7) // 8
+        self.union_bits = list()
+        for _ in range(2):
+            color_bits = list()
+            for _ in range(NUM_POINTS):
+                begin, end = end, end + self.bits_length
+                color_bits.append(int.from_bytes(self.mm[begin:end], "little"))
+            self.union_bits.append(color_bits)
+
+    def __len__(self):
+        return self.num_games
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.states.release()
+        self.mm.close()
+        self.f.close()
+
+    def search(self, pattern, anchored=True, swap_colors=True, max_games=None):
+        # Return the games which have the pattern in any corner and any
+        # symmetry, as (game id, move number, corner) of the first time it
+        # appears, in the order of the game id. The move number counts the
+        # moves played.
+        if not isinstance(pattern, Pattern):
+            pattern = Pattern(pattern)
+        variants = pattern.get_variants(anchored, swap_colors)
+
+        # The corners whose unions have the stones of any variant.
+        candidates = 0
+        for black, white, _ in variants:
+            corners = (1 << self.num_corners) - 1
+            for color, mask in enumerate([black, white]):
+                while mask and corners:
+                    low = mask & -mask
+                    corners &= self.union_bits[color][low.bit_length() - 1]
+                    mask ^= low
+            candidates |= corners
+
+        # Walk the candidates once in the order of the corner, and test all
+        # variants on their states.
+        result = list()
+        game = None
+        data = candidates.to_bytes(self.bits_length, "little")
+        for byte_idx, byte in enumerate(data):
+            if byte == 0:
+                continue
+            for bit in range(8):
+                if not (byte >> bit) & 1:
+                    continue
+                i = byte_idx * 8 + bit
+                ub, uw = self.black_unions[i], self.white_unions[i]
+                move_number = self._find_state(i, [ v for v in variants
+                                                        if not (v[0] & ~ub or v[1] & ~uw) ])
+                if move_number is None:
+                    continue
+                game_id, corner = divmod(i, NUM_CORNERS)
+                if not game is None and game[0] == game_id:
+                    if move_number < game[1]:
+                        game = (game_id, move_number, corner)
+                    continue
+                if not game is None:
+                    result.append(game)
+                    if len(result) == max_games:
+                        return result
+                game = (game_id, move_number, corner)
+        if not game is None and len(result) != max_games:
+            result.append(game)
+        return result
+
+    def _find_state(self, i, variants):
+        # The first move number where any variant appears in the corner i.
+        begin = STATE_FIELDS * self.offsets[i]
+        end = begin + STATE_FIELDS * self.counts[i]
+        states = self.states
+        for s in range(begin, end, STATE_FIELDS):
+            b, w = states[s+1], states[s+2]
+            for black, white, empty in variants:
+                if b & black == black and \
+                       w & white == white and \
+                       (b | w) & empty == 0:
+                    return states[s]
+        return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Build the pattern index of the game store.")
+    parser.add_argument("store", help="the game store file")
+    parser.add_argument("pattern", help="the pattern index file")
+    parser.add_argument("--workers", type=int, default=None, help="the number of processes")
+    args = parser.parse_args()
+
+    num_states = build_pattern_index(args.store, args.pattern, args.workers)
+    print("Recorded {} corner states.".format(num_states))
@@ -0,0 +1,203 @@
+from .gtp import GtpEngine
+from .analysis import AnalysisParser
+from .board import Board
+import concurrent.futures
+import threading
+import queue
+
+class GtpEnginePool:
+    # Several engine processes which analyze the positions in parallel. The
+    # jobs are put on one queue, and every engine has a worker thread which
+    # takes the next job as soon as the engine is free. The engine keeps the
+    # position of its last job, so a position which follows it only sends
+    # the new moves.
+    #
+    #     pool = GtpEnginePool("sayuri -w network.bin", num_engines=8, threads=4)
+    #     future = pool.submit(board, 400)
+    #     analysis = future.result()
+    REQUIRED_LIST = [
+        "clear_board",
+        "boardsize",
+        "komi",
+        "play",
+        "undo",
+        "sayuri-genmove_analyze"
+    ]
+    ANALYSIS_INTERVAL = 100 # centiseconds
+
+    def __init__(self, command, num_engines=1, threads=1):
+        # The threads is the '-t' of every engine, or a list of them.
+        if isinstance(threads, int):
+            threads = [threads] * num_engines
+        if len(threads) != num_engines:
+            raise Exception("The threads should be given for every engine.")
+
+        self.engines = list()
+        self._jobs = queue.Queue()
+        self._workers = list()
+
+        # Loading the weights takes time, so the engines are started
+        # together.
+        commands = [ "{} -t {}".format(command, t) for t in threads ]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_engines) as executor:
+            futures = [ executor.submit(self._start_engine, c) for c in commands ]
+        errors = [ f.exception() for f in futures if not f.exception() is None ]
+        self.engines = [ f.result() for f in futures if f.exception() is None ]
+        if len(errors) > 0:
+            self.close()
+            raise errors[0]
+
+        for engine in self.engines:
+            worker = threading.Thread(
+                target=self._work_loop, args=(engine,), daemon=True
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def _start_engine(self, command):
+        engine = GtpEngine(command)
+        for c in self.REQUIRED_LIST:
+            if not engine.support(c):
+                engine.quit()
+                engine.shutdown()
+                raise Exception("Need to support for GTP command: {}.".format(c))
+        return engine
+
+    def __len__(self):
+        return len(self.engines)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, board, visits, ownership=False):
+        # Return the future of the AnalysisParser of the position. The board
+        # must be played from the empty board, as the boards of the tree and
+        # the game store are, since the engine is given the moves.
+        future = concurrent.futures.Future()
+        self._jobs.put((board.copy(), visits, ownership, future))
+        return future
+
+    def close(self):
+        # The queued jobs are finished before the engines quit.
+        for _ in self._workers:
+            self._jobs.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = list()
+
+        for engine in self.engines:
+            engine.quit()
+            engine.shutdown()
+        self.engines = list()
+
+    def _work_loop(self, engine):
+        # The position of the engine, as (size, komi, rule, history, number
+        # of the placed stones). It is None when the position is unknown.
+        position = None
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            board, visits, ownership, future = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                position = self._sync(engine, position, board)
+                analysis = self._analyze(engine, board, visits, ownership)
+            except Exception as err:
+                position = None
+                future.set_exception(err)
+            else:
+                future.set_result(analysis)
+            finally:
+                # Nobody reads the queues of the pool engines.
+                engine.pop_query()
+                while not engine.analysis_empty():
+                    engine.get_analysis_line()
+
+    def _sync(self, engine, position, board):
+        rule = (board.board_size, board.komi, board.scoring_rule)
+        base = object()
+        placed = 0
+        if not position is None and position[:3] == rule:
+            base = position[3]
+            placed = position[4]
+
+        # The history is shared by the copies of the board, so the moves
+        # after the last position end at its history.
+        moves = list()
+        node = board.history
+        while not node is None and not node is base:
+            moves.append(node[0][0:2])
+            node = node[1]
+        moves.reverse()
+
+        cmds = list()
+        if not node is base:
+            placed = 0
+            if board.scoring_rule == Board.SCORING_TERRITORY:
+                scoring = "territory"
+            else:
+                scoring = "area"
+            cmds.extend([
+                "clear_board",
+                "boardsize {}".format(board.board_size),
+                "komi {}".format(board.komi)
+            ])
+            if engine.support("sayuri-setoption"):
+                cmds.append("sayuri-setoption name scoring rule value {}".format(scoring))
+
+        for vtx, color in moves:
+            if vtx == Board.RESIGN_VERTEX:
+                continue
+            if vtx != Board.PASS_VERTEX:
+                placed += 1
+            cmds.append("play {} {}".format(
+                board.get_gtp_color(color), board.get_gtp_vertex(vtx)))
+
+        # Every placed stone is on the board or captured, unless the
+        # position was set up without moves.
+        if placed != board.count_stones(Board.BLACK) + board.count_stones(Board.WHITE) + \
+                         board.prisoners[Board.BLACK] + board.prisoners[Board.WHITE]:
+            raise Exception("The board is not played from the empty board.")
+
+        if len(cmds) > 0:
+            for query in engine.send_commands(cmds):
+                query.future.result()
+                if query.result != "=":
+                    raise Exception("Fail to sync the engine: ({}).".format(query.gtp_command.strip()))
+        return rule + (board.history, placed)
+
+    def _analyze(self, engine, board, visits, ownership):
+        gtp_command = "sayuri-genmove_analyze {} {} playouts {}".format(
+                          board.get_gtp_color(board.to_move), self.ANALYSIS_INTERVAL, visits)
+        if ownership:
+            gtp_command += " ownership true"
+        query = engine.send_command(gtp_command)
+        if not query:
+            raise Exception("Fail to send the command: ({}).".format(gtp_command))
+        query.future.result()
+        if query.result != "=":
+            raise Exception("Invalid command: ({}).".format(str(query)))
+
+        last_line = None
+        playmove = None
+        for line in query.get_response():
+            if line.startswith("info"):
+                last_line = line
+            elif line.startswith("play"):
+                playmove = line.split()[-1]
+
+        # The engine plays the move of the search. Take it back to keep the
+        # position.
+        if not playmove is None and playmove.lower() != "resign":
+            undo = engine.send_command("undo")
+            if not undo or undo.future.result().result != "=":
+                raise Exception("Fail to undo the move of the search.")
+
+        if last_line is None:
+            raise Exception("The engine returns no analysis.")
+        return AnalysisParser(last_line)
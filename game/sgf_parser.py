@@ -1,84 +1,268 @@
 from .board import Board
 from .tree import Tree, NodeKey
 from datetime import datetime
+import io
+import re
 
-def _load_sgf_based(sgf, sgf_board, sgf_tree, raise_err):
-    def process_key_value(key, val, board, tree):
-        def as_vertex_move(m, board):
-            if len(m) == 0 or m == "tt":
-                return board.PASS_VERTEX
-            x = ord(m[0]) - ord('a')
-            y = ord(m[1]) - ord('a')
-            y = board.board_size - 1 - y
-            return board.get_vertex(x, y)
+class SgfTokenizer:
+    # Split the SGF into the tokens "(", ")", ";" and the properties,
+    # (name, [values]). The source may be a string or a file object, which
+    # is read in chunks, so a large file is not loaded at once.
+    CHUNK_SIZE = 64 * 1024
 
+    NAME_RE = re.compile(r"[A-Za-z]*")
+    SPACE_RE = re.compile(r"\s*")
+    VALUE_RE = re.compile(r"(?:[^\]\\]|\\.)*\]", re.S)
+    ESCAPE_RE = re.compile(r"\\(?:\r\n|\n\r|\n|\r|(.))", re.S)
+
+    # The common property, whose values have no backslash.
+    PLAIN_RE = re.compile(r"([A-Z]+)((?:\s*\[[^\]\\]*\])+)")
+    PLAIN_VALUE_RE = re.compile(r"\[([^\]]*)\]")
+
+    def __init__(self, source, chunk_size=CHUNK_SIZE):
+        self.source = source
+        self.chunk_size = chunk_size
+        self.buf = str()
+        self.pos = 0
+        self.eof = False
+        if isinstance(source, str):
+            self.buf = source
+            self.eof = True
+
+    def __iter__(self):
+        while True:
+            if not self._skip_space():
+                return
+            c = self.buf[self.pos]
+            if c in "();":
+                self.pos += 1
+                yield c
+            elif c.isalpha():
+                prop = self._next_plain_property()
+                if prop is None:
+                    prop = self._next_property()
+                yield prop
+            else:
+                raise Exception("Invalid SGF file.")
+
+    def _fill(self):
+        # Drop the consumed text and append the next chunk. Return the
+        # shift of the indices, or None at the end of file.
+        if self.eof:
+            return None
+        chunk = self.source.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return None
+        shift = self.pos
+        self.buf = self.buf[shift:] + chunk
+        self.pos = 0
+        return shift
+
+    def _skip_space(self):
+        while True:
+            self.pos = self.SPACE_RE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return True
+            if self._fill() is None:
+                return False
+
+    def _next_plain_property(self):
+        m = self.PLAIN_RE.match(self.buf, self.pos)
+        if m is None:
+            return None
+        # The property is complete only if something other than a value
+        # follows it in the buffer.
+        idx = self.SPACE_RE.match(self.buf, m.end()).end()
+        if idx == len(self.buf) or self.buf[idx] == '[':
+            return None
+        self.pos = idx
+        return m.group(1), self.PLAIN_VALUE_RE.findall(m.group(2))
+
+    def _next_property(self):
+        # The property is read from self.pos, which is kept until the whole
+        # property is found, so the buffer never drops a part of it.
+        idx = self.NAME_RE.match(self.buf, self.pos).end()
+        while idx == len(self.buf):
+            shift = self._fill()
+            if shift is None:
+                break
+            idx = self.NAME_RE.match(self.buf, idx - shift).end()
+
+        # Ignore the lower case letters of the old FF[3] names.
+        name = "".join(c for c in self.buf[self.pos:idx] if c.isupper())
+        spans = list()
+        while True:
+            idx = self.SPACE_RE.match(self.buf, idx).end()
+            if idx == len(self.buf):
+                shift = self._fill()
+                if shift is None:
+                    break
+                idx -= shift
+                spans = [ (b - shift, e - shift) for b, e in spans ]
+                continue
+            if self.buf[idx] != '[':
+                break
+            begin = idx + 1
+            end = self._find_value_end(begin)
+            while end < 0:
+                shift = self._fill()
+                if shift is None:
+                    raise Exception("Invalid SGF file.")
+                begin -= shift
+                spans = [ (b - shift, e - shift) for b, e in spans ]
+                end = self._find_value_end(begin)
+            spans.append((begin, end))
+            idx = end + 1
+
+        values = [ self._unescape(self.buf[b:e]) for b, e in spans ]
+        self.pos = idx
+        if len(values) == 0:
+            raise Exception("Invalid SGF file.")
+        return name, values
+
+    def _find_value_end(self, begin):
+        # Find the "]" which is not escaped by a backslash. Most values
+        # have no backslash, so try the plain search first.
+        end = self.buf.find(']', begin)
+        if end < 0:
+            return -1
+        if self.buf.find('\\', begin, end) < 0:
+            return end
+        m = self.VALUE_RE.match(self.buf, begin)
+        if m is None:
+            return -1
+        return m.end() - 1
+
+    def _unescape(self, val):
+        # The escaped line break is removed, and the other escaped
+        # characters are kept.
+        if not '\\' in val:
+            return val
+        return self.ESCAPE_RE.sub(r"\1", val)
+
+def _process_sgf_node(props, board, tree, lazy):
+    def as_vertex_move(m, board):
+        if len(m) == 0 or m == "tt":
+            return board.PASS_VERTEX
+        x = ord(m[0]) - ord('a')
+        y = ord(m[1]) - ord('a')
+        y = board.board_size - 1 - y
+        return board.get_vertex(x, y)
+
+    def reset_board(board, board_size, komi, scoring_rule):
+        board.reset(board_size, komi, scoring_rule)
+        if not tree is None:
+            tree.get_val()["board"].copy_from(board)
+
+    move = None
+    comment = None
+    properties = dict()
+    for key, values in props:
+        val = values[0]
         if key == "SZ":
-            board_size = int(val)
-            board.reset(board_size, board.komi, board.scoring_rule)
-            if not tree is None:
-                tree.get_val()["board"].copy_from(board)
+            reset_board(board, int(val), board.komi, board.scoring_rule)
         elif key == "KM":
-            komi = float(val)
-            board.reset(board.board_size, komi, board.scoring_rule)
-            if not tree is None:
-                tree.get_val()["board"].copy_from(board)
+            reset_board(board, board.board_size, float(val), board.scoring_rule)
         elif key == "RU":
             scoring_rule = board.transform_scoring_rule(val)
-            board.reset(board.board_size, board.komi, scoring_rule)
-            if not tree is None:
-                tree.get_val()["board"].copy_from(board)
+            reset_board(board, board.board_size, board.komi, scoring_rule)
         elif key == "C":
-            if not tree is None:
-                tree.get_val()["comment"] = val
+            comment = val
         elif key == "B":
-            vtx = board.get_gtp_vertex(as_vertex_move(val, board))
-            col = board.get_gtp_color(board.BLACK)
-            board.play(vtx, to_move=col)
-            if not tree is None:
-                tree.add_and_forward(NodeKey(col, vtx), { "board" : board.copy() })
+            move = (board.BLACK, val)
         elif key == "W":
-            vtx = board.get_gtp_vertex(as_vertex_move(val, board))
-            col = board.get_gtp_color(board.WHITE)
+            move = (board.WHITE, val)
+        elif key == "AB" or key == "AW":
+            raise Exception("Do not support for AB/AW tag in the SGF file.")
+        else:
+            properties[key] = values
+
+    if not move is None:
+        color, val = move
+        vtx = board.get_gtp_vertex(as_vertex_move(val, board))
+        col = board.get_gtp_color(color)
+        parent = None if tree is None else tree.curr
+        default = None if parent is None else parent.default
+        if lazy:
+            # Only keep the move. The tree plays it when the board of the
+            # node is requested.
+            tree.add_and_forward(NodeKey(col, vtx), dict())
+        else:
             board.play(vtx, to_move=col)
             if not tree is None:
                 tree.add_and_forward(NodeKey(col, vtx), { "board" : board.copy() })
-        elif key == "AB" or key == "AW":
-            raise Exception("Do not support for AB/AW tag in the SGF file.")
+        if not default is None:
+            # The first variation stays the default child, even if a later
+            # variation starts with the same move and adds another child.
+            parent.default = default
+    if not tree is None:
+        if not comment is None:
+            tree.get_val()["comment"] = comment
+        if len(properties) > 0:
+            tree.get_val()["properties"] = properties
+
+def _load_sgf_based(sgf, sgf_board, sgf_tree, raise_err, lazy=False):
+    # Build the whole game tree. The first variation of every node is the
+    # default child, so the main line ends where the first variation is
+    # closed, and both the board and the tree are left there. In the lazy
+    # mode, the moves are not played, and the board stays at the root.
     try:
-        level = 0
-        idx = 0
-        node_cnt = 0
-        key = str()
-        while idx < len(sgf):
-            c = sgf[idx]
-            idx += 1;
-
-            if c == '(':
-                level += 1
-            elif c == ')':
-                level -= 1
-
-            if c in ['(', ')', '\t', '\n', '\r'] or level != 1:
+        stack = list()
+        props = None
+        main_board = None
+        main_node = None
+        for token in SgfTokenizer(sgf):
+            if not isinstance(token, str):
+                if props is None:
+                    raise Exception("Invalid SGF file.")
+                props.append(token)
                 continue
-            elif c == ';':
-                node_cnt += 1
-            elif c == '[':
-                end = sgf.find(']', idx)
-                val = sgf[idx:end]
-                process_key_value(key, val, sgf_board, sgf_tree)
-                key = str()
-                idx = end+1
-            else:
-                key += c
+
+            if not props is None:
+                _process_sgf_node(props, sgf_board, sgf_tree, lazy)
+                props = None
+
+            if token == ';':
+                if len(stack) == 0:
+                    raise Exception("Invalid SGF file.")
+                props = list()
+            elif token == '(':
+                node = None if sgf_tree is None else sgf_tree.curr
+                stack.append((sgf_board.copy(), node))
+            elif token == ')':
+                if len(stack) == 0:
+                    raise Exception("Invalid SGF file.")
+                if main_board is None:
+                    main_board = sgf_board.copy()
+                    main_node = None if sgf_tree is None else sgf_tree.curr
+                board, node = stack.pop()
+                sgf_board.copy_from(board)
+                if not sgf_tree is None:
+                    while not sgf_tree.curr is node:
+                        sgf_tree.backward()
+                if len(stack) == 0:
+                    # Only load the first game of the collection.
+                    break
+        if not props is None:
+            _process_sgf_node(props, sgf_board, sgf_tree, lazy)
+            props = None
+        if not main_board is None:
+            sgf_board.copy_from(main_board)
+            if not sgf_tree is None:
+                sgf_tree.goto(main_node)
     except Exception as err:
         if raise_err:
             raise err
 
-def load_sgf_as_tree(sgf, raise_err=False):
+def load_sgf_as_tree(sgf, raise_err=False, checkpoint_interval=None, lazy=False):
+    # If the lazy is set, only the structure of the tree is built, and the
+    # boards are computed when they are visited. The illegal moves are not
+    # found until then.
     board = Board(19, 7.5, Board.SCORING_AREA)
-    tree = Tree({ "board" : board.copy() })
+    tree = Tree({ "board" : board.copy() }, checkpoint_interval)
     try:
-        _load_sgf_based(sgf, board, tree, raise_err)
+        _load_sgf_based(sgf, board, tree, raise_err, lazy)
     except Exception as err:
         if raise_err:
             raise err
@@ -87,41 +271,138 @@ def load_sgf_as_tree(sgf, raise_err=False):
 
 def load_sgf_as_board(sgf, raise_err=False):
     board = Board(19, 7.5, Board.SCORING_AREA)
-    tree = Tree({ "board" : board.copy() })
     try:
-        _load_sgf_based(sgf, board, tree, raise_err)
+        _load_sgf_based(sgf, board, None, raise_err)
     except Exception as err:
         if raise_err:
             raise err
         return None
     return board
 
-def transform_tree_to_sgf(tree, black="NA", white="NA", result=None):
-    board = tree.get_val()["board"]
-    sgf = "(;GM[1]FF[4]SZ[{}]KM[{}]RU[{}]PB[{}]PW[{}]DT[{}]".format(
-              board.board_size, board.komi,
-              board.transform_scoring_rule(board.scoring_rule),
-              black, white,
-              datetime.now().strftime("%Y-%m-%d-%H:%M:%S"))
-    if result:
-        sgf += "RE[{}]".format(result)
-
-    for node in tree.get_root_mainpath():
+class SgfWriter:
+    # Write the whole game tree, with every variation, to a file object.
+    # The text is collected in a small buffer and written in blocks.
+    BUFFER_SIZE = 64 * 1024
+
+    # The custom property of the analysis summary, "black winrate, black
+    # score, drawrate, best move".
+    ANALYSIS_PROPERTY = "SY"
+
+    def __init__(self, f, buffer_size=BUFFER_SIZE):
+        self.f = f
+        self.buffer_size = buffer_size
+        self.buf = list()
+        self.buf_len = 0
+
+    def write_tree(self, tree, black=None, white=None, result=None):
+        board = tree.root.get_val()["board"]
+        header = [
+            ("GM", "1"),
+            ("FF", "4"),
+            ("SZ", board.board_size),
+            ("KM", board.komi),
+            ("RU", board.transform_scoring_rule(board.scoring_rule))
+        ]
+
+        # The game information which is not given comes from the loaded
+        # SGF file.
+        properties = tree.root.get_val().get("properties", dict())
+        for key, val, default in [
+                ("PB", black, "NA"),
+                ("PW", white, "NA"),
+                ("DT", None, datetime.now().strftime("%Y-%m-%d-%H:%M:%S")),
+                ("RE", result, None) ]:
+            if not val:
+                val = properties.get(key, [ default ])[0]
+            if val:
+                header.append((key, val))
+
+        self._write("(;")
+        for key, val in header:
+            self._write("{}[{}]".format(key, self._escape(str(val))))
+        self._write_node_properties(
+            tree.root, board.board_size, [ key for key, _ in header ] + [ "RE" ])
+
+        # Walk the tree without recursion. The ")" of a variation is kept
+        # in the stack until all of its nodes are written.
+        stack = self._get_children(tree.root)
+        while len(stack) > 0:
+            item = stack.pop()
+            if isinstance(item, str):
+                self._write(item)
+                continue
+            self._write(";")
+            self._write_node_properties(item, board.board_size)
+            stack.extend(self._get_children(item))
+        self._write(")")
+        self.flush()
+
+    def flush(self):
+        if len(self.buf) > 0:
+            self.f.write("".join(self.buf))
+            self.buf.clear()
+            self.buf_len = 0
+
+    def _write(self, text):
+        self.buf.append(text)
+        self.buf_len += len(text)
+        if self.buf_len >= self.buffer_size:
+            self.flush()
+
+    def _get_children(self, node):
+        # Return the items to push, in the reversed order. The default child
+        # is the first variation, so it stays the main line.
+        children = list(node.children.values())
+        if len(children) == 0:
+            return list()
+        if len(children) == 1:
+            return children
+        if not node.default is None:
+            children.remove(node.default)
+            children.insert(0, node.default)
+        items = list()
+        for child in reversed(children):
+            items.extend([ ")", child, "(" ])
+        return items
+
+    def _write_node_properties(self, node, board_size, skip=()):
         if not node.get_key() is None:
             col, vtx = node.get_key().unpack()
             cstr = "B" if col.is_black() else "W"
             if vtx.is_pass():
-                vstr = "tt" if board.board_size <= 19 else ""
-            elif vtx.is_resign():
-                pass
-            else:
+                self._write("{}[{}]".format(cstr, "tt" if board_size <= 19 else ""))
+            elif not vtx.is_resign():
                 x, y = vtx.get()
-                y = board.board_size - 1 - y
-                vstr = str()
-                vstr += chr(x + ord('a'))
-                vstr += chr(y + ord('a'))
-            sgf += ";{}[{}]".format(cstr, vstr)
-        if not node.get_val().get("comment") is None:
-            sgf += "C[{}]".format(node.get_val()["comment"])
-    sgf += ")"
-    return sgf
+                y = board_size - 1 - y
+                self._write("{}[{}{}]".format(cstr, chr(x + ord('a')), chr(y + ord('a'))))
+
+        val = node.get_val()
+        if not val.get("comment") is None:
+            self._write("C[{}]".format(self._escape(val["comment"])))
+
+        stats = node.stats
+        if not stats is None:
+            blackwinrate, blackscore, drawrate, _, bestmove = stats
+            self._write("{}[{:.4f} {:.2f} {:.4f} {}]".format(
+                self.ANALYSIS_PROPERTY, blackwinrate, blackscore, drawrate, bestmove))
+
+        properties = val.get("properties")
+        if not properties is None:
+            for key, values in properties.items():
+                if key in skip or \
+                       (key == self.ANALYSIS_PROPERTY and not stats is None):
+                    continue
+                self._write(key)
+                for v in values:
+                    self._write("[{}]".format(self._escape(v)))
+
+    def _escape(self, val):
+        return val.replace("\\", "\\\\").replace("]", "\\]")
+
+def write_tree_to_sgf(tree, f, black=None, white=None, result=None):
+    SgfWriter(f).write_tree(tree, black, white, result)
+
+def transform_tree_to_sgf(tree, black=None, white=None, result=None):
+    f = io.StringIO()
+    write_tree_to_sgf(tree, f, black, white, result)
+    return f.getvalue()
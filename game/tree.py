@@ -1,24 +1,82 @@
-import random
+from .gtp import GtpColor, GtpVertex
+from collections import OrderedDict
+from array import array
+import itertools
 
 class NodeKey:
-    def __init__(self, color, vertex):
-        self.color = color
-        self.vertex = vertex
+    # The keys are interned. The same move always gives the same object,
+    # whose identity is the packed integer of the color and the vertex.
+    __slots__ = ("color", "vertex", "packed")
+    _interned = dict()
+
+    def __new__(cls, color, vertex):
+        packed = cls._pack(color, vertex)
+        key = cls._interned.get(packed)
+        if key is None:
+            key = super(NodeKey, cls).__new__(cls)
+            key.color = GtpColor(color.to_str())
+            key.vertex = GtpVertex(vertex.get())
+            key.packed = packed
+            cls._interned[packed] = key
+        return key
+
+    @staticmethod
+    def _pack(color, vertex):
+        if color.is_black():
+            color_bit = 0
+        elif color.is_white():
+            color_bit = 1
+        else:
+            raise Exception("Invalid color.")
+
+        val = vertex.get()
+        if isinstance(val, tuple):
+            x, y = val
+            code = y * 25 + x
+        elif val is None:
+            code = 25 * 25 + 3
+        else:
+            code = 25 * 25 + (val - GtpVertex.PASS_VERTEX)
+        return (code << 1) | color_bit
 
     def unpack(self):
         return self.color, self.vertex
 
     def __eq__(self, other):
-        return self.__hash__() == hash(other)
+        if not isinstance(other, NodeKey):
+            return False
+        return self.packed == other.packed
 
     def __str__(self):
         return "{}-{}".format(self.color, self.vertex)
 
     def __hash__(self):
-        ret = hash(self.__str__())
-        return ret
+        return self.packed
+
+class NodeVal(dict):
+    # The value of a node which does not keep its own board. The board is
+    # rebuilt by the tree when it is requested. The move of the unchecked
+    # value was added without a board, so it is validated when the board
+    # is built.
+    __slots__ = ("_tree", "_node", "_checked")
+
+    def __init__(self, tree, node, data, checked=True):
+        super(NodeVal, self).__init__(data)
+        self._tree = tree
+        self._node = node
+        self._checked = checked
+
+    def __missing__(self, key):
+        if key == "board":
+            return self._tree._load_board(self._node)
+        raise KeyError(key)
+
+# The tags only need to be unique, so a counter is enough.
+_tag_counter = itertools.count()
 
 class Node:
+    __slots__ = ("val", "key", "depth", "parent", "default", "children", "tag", "hash_key", "stats")
+
     def __init__(self, val, key=None, parent=None, depth=0):
         self.val = val
         self.key = key
@@ -26,7 +84,12 @@ class Node:
         self.parent = parent
         self.default = None
         self.children = dict()
-        self.tag = random.randint(0, 18446744073709551615)
+        self.tag = next(_tag_counter)
+        self.hash_key = None
+
+        # The summary of the analysis, (black winrate, black score, drawrate,
+        # best policy, best move), or None if there is no analysis.
+        self.stats = None
 
     def try_add_child(self, key, val):
         if not key in self.children.keys():
@@ -34,7 +97,7 @@ class Node:
         self.default = self.children[key]
 
     def update_tag(self):
-        self.tag = random.randint(0, 18446744073709551615) # range of uint64
+        self.tag = next(_tag_counter)
 
     def get_tag(self):
         return self.tag
@@ -57,10 +120,31 @@ class Node:
         return self.key
 
 class Tree:
-    def __init__(self, val):
+    def __init__(self, val, checkpoint_interval=None, cache_size=64, transposition=False):
+        # If the checkpoint interval is set, only the nodes whose depth is
+        # a multiple of it keep the full board. The other nodes keep the
+        # move only, and their boards are replayed from the closest
+        # checkpoint and held in a small LRU cache.
+        self.checkpoint_interval = checkpoint_interval
+        self.cache_size = cache_size
+        self._board_cache = OrderedDict()
+
+        # If the transposition is set, the nodes of the same position (the
+        # same board hash) share one analysis record.
+        self.transposition = transposition
+        self._analysis_table = dict()
+
         self.root = Node(val)
         self.curr = self.root
 
+        # The nodes from the root to the current node.
+        self.path = [ self.root ]
+
+        # The statistics of the main line, rebuilt only after the main
+        # line or its analysis is changed.
+        self._mainline_stats = None
+        self._update_stats(self.root)
+
     def reset(self, val):
         self.root.val = val
         self.root.key = None
@@ -68,7 +152,14 @@ class Tree:
         self.root.default = None
         self.root.children.clear()
         self.root.update_tag()
+        self.root.hash_key = None
+        self.root.stats = None
         self.curr = self.root
+        self.path = [ self.root ]
+        self._board_cache.clear()
+        self._analysis_table.clear()
+        self._mainline_stats = None
+        self._update_stats(self.root)
 
     def get_tag(self):
         return self.curr.get_tag()
@@ -88,6 +179,9 @@ class Tree:
     def get_parent(self):
         return self.curr.parent
 
+    def get_path(self):
+        return self.path
+
     def get_root_mainpath(self):
         path = self.root
         while path:
@@ -95,8 +189,30 @@ class Tree:
             path = path.default
 
     def add_and_forward(self, key, val):
+        is_new = not key in self.curr.children
+        default = self.curr.default
         self.curr.try_add_child(key, val)
+        if not self.curr.default is default:
+            self._mainline_stats = None
         self.curr = self.curr.default
+        self.path.append(self.curr)
+        if is_new:
+            self._pack_node(self.curr)
+            self._update_stats(self.curr)
+        self._share_analysis(self.curr)
+
+    def set_analysis(self, analysis):
+        self.curr.val["analysis"] = analysis
+        self._record_analysis(self.curr)
+        self._update_stats(self.curr)
+
+    def get_mainline_stats(self):
+        # The statistics of every node on the main line, as arrays indexed
+        # by the depth. If a node has no analysis, it takes the one of the
+        # next analyzed node.
+        if self._mainline_stats is None:
+            self._mainline_stats = self._compute_mainline_stats()
+        return self._mainline_stats
 
     def update_tag(self):
         self.curr.update_tag()
@@ -104,17 +220,68 @@ class Tree:
     def forward(self):
         if self.curr.default:
             self.curr = self.curr.default
+            self.path.append(self.curr)
+            self._share_analysis(self.curr)
             return True
         return False
 
     def backward(self):
         if self.curr.parent:
             self.curr = self.curr.parent
+            self.path.pop()
+            self._share_analysis(self.curr)
             return True
         return False
 
+    def goto(self, node):
+        # Jump to any node of the tree. Only the path below the common
+        # ancestor is changed, and the default children along the new path
+        # are updated, so forward() follows it.
+        ancestor = self.get_common_ancestor(self.curr, node)
+        del self.path[ancestor.depth+1:]
+
+        branch = list()
+        curr = node
+        while not curr is ancestor:
+            branch.append(curr)
+            curr = curr.parent
+        for curr in reversed(branch):
+            if not curr.parent.default is curr:
+                curr.parent.default = curr
+                self._mainline_stats = None
+            self.path.append(curr)
+        self.curr = node
+        self._share_analysis(self.curr)
+
+    def goto_move(self, num_move):
+        # Jump to the given depth on the current path, or follow the default
+        # children if it is deeper than the current node.
+        if num_move < 0:
+            return False
+        if num_move <= self.curr.depth:
+            self.curr = self.path[num_move]
+            del self.path[num_move+1:]
+            self._share_analysis(self.curr)
+            return True
+        while self.curr.depth < num_move:
+            if not self.forward():
+                return False
+        return True
+
+    def get_common_ancestor(self, node, other):
+        while node.depth > other.depth:
+            node = node.parent
+        while other.depth > node.depth:
+            other = other.parent
+        while not node is other:
+            node = node.parent
+            other = other.parent
+        return node
+
     def copy_from(self, other):
         self.reset(other.root.get_val())
+        self._record_analysis(self.root)
+        self._update_stats(self.root)
         src_nodes = [ other.root ]
         dst_nodes = [ self.root ]
         while len(dst_nodes) > 0:
@@ -122,6 +289,171 @@ class Tree:
             dst = dst_nodes.pop(-1)
             for key in src.get_children_keys():
                 dst.try_add_child(key, src.get_children_val(key))
+                child = dst.children[key]
+                child.hash_key = src.children[key].hash_key
+                self._pack_node(child)
+                self._record_analysis(child)
+                self._update_stats(child)
+            # try_add_child() moves the default to the last child, so
+            # keep the default of the source.
+            if not src.default is None:
+                dst.default = dst.children[src.default.get_key()]
             for key in src.get_children_keys():
                 src_nodes.append(src.children[key])
                 dst_nodes.append(dst.children[key])
+
+    def _get_hash_key(self, node):
+        # The key is computed from the board at the first use and kept
+        # in the node, so the boards of packed nodes are not rebuilt again.
+        if node.hash_key is None:
+            try:
+                node.hash_key = node.val["board"].hash_key
+            except KeyError:
+                return None
+        return node.hash_key
+
+    def _record_analysis(self, node):
+        analysis = node.val.get("analysis")
+        if not self.transposition or analysis is None:
+            return
+        hash_key = self._get_hash_key(node)
+        if not hash_key is None:
+            self._analysis_table[hash_key] = analysis
+
+    def _share_analysis(self, node):
+        # Show the latest analysis of the same position.
+        if not self.transposition or \
+               len(self._analysis_table) == 0:
+            return
+        hash_key = self._get_hash_key(node)
+        if hash_key is None:
+            return
+        analysis = self._analysis_table.get(hash_key)
+        if not analysis is None and \
+               not node.val.get("analysis") is analysis:
+            node.val["analysis"] = analysis
+            self._update_stats(node)
+
+    def _update_stats(self, node):
+        analysis = node.val.get("analysis")
+        if analysis is None:
+            stats = None
+        else:
+            if node.key is None:
+                board = node.val["board"]
+                col = board.get_gtp_color(board.to_move)
+            else:
+                col = node.key.color.next()
+            info = analysis.get_sorted_moves()[0]
+            if col.is_black():
+                blackwinrate = info["winrate"]
+                blackscore = info["scorelead"]
+            else:
+                blackwinrate = 1.0 - info["winrate"]
+                blackscore = -info["scorelead"]
+            stats = (blackwinrate, blackscore, info["drawrate"], info["prior"], info["move"])
+        if stats is None and node.stats is None:
+            return
+        node.stats = stats
+        self._mainline_stats = None
+
+    def _compute_mainline_stats(self):
+        nodes = list(self.get_root_mainpath())
+        size = len(nodes)
+        blackwinrate = array("d", bytes(8 * size))
+        blackscore = array("d", bytes(8 * size))
+        drawrate = array("d", bytes(8 * size))
+        bestpolicy = array("d", bytes(8 * size))
+        bestmove = [ None ] * size
+        valid = bytearray(size)
+
+        # Walk backward, so the nodes without analysis take the values of
+        # the next analyzed node.
+        curr = (0.5, 0.0, 1.0)
+        no_stats = True
+        for i in range(size-1, -1, -1):
+            stats = nodes[i].stats
+            if not stats is None:
+                curr = stats[0:3]
+                bestpolicy[i] = stats[3]
+                bestmove[i] = stats[4]
+                no_stats = False
+            blackwinrate[i], blackscore[i], drawrate[i] = curr
+            valid[i] = not no_stats
+        return {
+            "blackwinrate" : blackwinrate,
+            "blackscore" : blackscore,
+            "drawrate" : drawrate,
+            "bestpolicy" : bestpolicy,
+            "bestmove" : bestmove,
+            "valid" : valid
+        }
+
+    def _pack_node(self, node):
+        val = node.val
+        if isinstance(val, NodeVal):
+            # bind the value to this tree
+            node.val = NodeVal(self, node, val, val._checked)
+            return
+        if val.get("board") is None:
+            # The value without board, such as the lazily loaded SGF
+            # node. The board is built when it is requested.
+            node.val = NodeVal(self, node, val, False)
+            return
+        if self._is_checkpoint(node):
+            return
+        val = val.copy()
+        board = val.pop("board")
+        node.val = NodeVal(self, node, val)
+        self._cache_board(node, board)
+
+    def _is_checkpoint(self, node):
+        return self.checkpoint_interval is None or \
+                   node.depth % self.checkpoint_interval == 0
+
+    def _cache_board(self, node, board):
+        self._board_cache[node] = board
+        self._board_cache.move_to_end(node)
+        while len(self._board_cache) > self.cache_size:
+            self._board_cache.popitem(last=False)
+
+    def _load_board(self, node):
+        board = self._board_cache.get(node)
+        if not board is None:
+            self._board_cache.move_to_end(node)
+            return board
+
+        # find the closest node which has a board
+        path = list()
+        curr = node
+        while True:
+            if "board" in curr.val:
+                base = curr.val["board"]
+                break
+            base = self._board_cache.get(curr)
+            if not base is None:
+                break
+            path.append(curr)
+            curr = curr.parent
+
+        # Only the unchecked moves are validated. The others were checked
+        # when they were added to the tree. The checkpoint nodes on the way
+        # keep their boards, so the next replay starts closer.
+        board = base.copy()
+        for curr in reversed(path):
+            col, vtx = curr.get_key().unpack()
+            checked = not isinstance(curr.val, NodeVal) or curr.val._checked
+            try:
+                board.play_sequence([ vtx ], [ col ], validate=not checked)
+            except Exception:
+                raise Exception("The move {} {} at depth {} is illegal.".format(col, vtx, curr.depth))
+            if not checked:
+                curr.val._checked = True
+            if not curr is node and self._is_checkpoint(curr):
+                curr.val["board"] = board.copy()
+
+        if self._is_checkpoint(node):
+            node.val["board"] = board
+        else:
+            self._cache_board(node, board)
+        return board
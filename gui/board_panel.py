@@ -135,7 +135,7 @@ class BoardPanelWidget(SimpleBoardPanelWidget):
             xd, xp, yd, yp = self._find_closest(touch.pos)
             prev_ghost = self.ghost_stone
             if self.board.num_passes < 2 and \
-                   self.board.legal((xp, yp)) and \
+                   self.is_legal_point(xp, yp) and \
                    max(yd, xd) < self.grid_size / 2:
                 self.ghost_stone = (xp, yp)
             else:
@@ -161,7 +161,7 @@ class BoardPanelWidget(SimpleBoardPanelWidget):
             if self.ghost_stone:
                 xd, xp, yd, yp = self._find_closest(touch.pos)
                 if self.board.num_passes < 2 and \
-                       self.board.legal((xp, yp)) and \
+                       self.is_legal_point(xp, yp) and \
                        max(yd, xd) < self.grid_size / 2:
                     col = self.board.get_gtp_color(self.board.to_move)
                     vtx = self.board.get_gtp_vertex((xp, yp))
@@ -178,10 +178,19 @@ class BoardPanelWidget(SimpleBoardPanelWidget):
         self.draw_board_only()
         self.last_board_content_tag = None
 
+    def is_legal_point(self, x, y):
+        # The mask is computed once per position and shared by every
+        # touch event.
+        return self.board.legal_mask()[self.board.get_index(x, y)]
+
     def undo_move(self):
         succ = self.tree.backward()
         if succ:
-            self.board.copy_from(self.tree.get_val()["board"])
+            # Take back the move in place. The dead stones of the final
+            # position are not in the move records, so copy the board then.
+            if self.board.num_passes >= 2 or \
+                   not self.board.undo():
+                self.board.copy_from(self.tree.get_val()["board"])
             self.engine.do_action({ "action" : "undo" })
         return succ
 
@@ -189,7 +198,15 @@ class BoardPanelWidget(SimpleBoardPanelWidget):
         succ = self.tree.forward()
         if succ:
             col, vtx = self.tree.get_key().unpack()
-            self.board.copy_from(self.tree.get_val()["board"])
+            try:
+                self.board.play(vtx, to_move=col)
+            except Exception:
+                # The illegal move of a lazily loaded variation. Stay at
+                # the last legal node.
+                self.tree.backward()
+                return False
+            if self.board.num_passes >= 2:
+                self.board.copy_from(self.tree.get_val()["board"])
             self.engine.do_action(
                 { "action" : "play", "color" : col, "vertex" : vtx }
             )
@@ -249,7 +266,11 @@ class BoardPanelWidget(SimpleBoardPanelWidget):
         if self.last_board_content_tag == curr_tag:
             return
         self.last_board_content_tag = curr_tag
-        board = self.tree.get_val()["board"]
+        try:
+            board = self.tree.get_val()["board"]
+        except Exception:
+            # The board of an illegal move can not be built.
+            return
 
         # synchronize PV board
         forbid_pv = self.forbid_pv or \
@@ -268,12 +289,11 @@ class BoardPanelWidget(SimpleBoardPanelWidget):
                        info["move"].get() == self.pv_start_pos:
                     main_info = info
                     pv_list = info["pv"]
-            for vtx in pv_list:
-                try:
-                    board.play(vtx)
-                except Exception:
-                    # not a legal move
-                    break
+            try:
+                board.play_sequence(pv_list)
+            except Exception:
+                # not a legal move, keep the moves before it
+                pass
 
         self.canvas.clear()
         with self.canvas:
@@ -8,6 +8,12 @@ class GameMode(Enum):
     ANALYZING = 1
     PLAYING = 2
 
+class EngineState(Enum):
+    NONE = 0
+    STARTING = 1
+    READY = 2
+    FAILED = 3
+
 class BackgroundColor(Widget):
     pass
 
@@ -1,8 +1,10 @@
 from kivy.core.window import Window
+from kivy.clock import mainthread
 from kivy.storage.jsonstore import JsonStore
-import time
+import threading
+import sys
 
-from .common import GameMode
+from .common import GameMode, EngineState
 
 from game.gtp import GtpEngine, GtpVertex
 from game.board import Board
@@ -14,18 +16,29 @@ class EngineControls:
     def __init__(self, parent, default_config):
         self.parent = parent
         self.engine = None
-
-        command = self._get_command(default_config.get("engine"))
-        try:
-            if not command is None:
-                self.engine = GtpEngine(command)
-        except Exception:
-            self.engine = None
-        self._check_engine()
+        self.state = EngineState.NONE
 
         self.last_rep_command = str()
         self.last_rep = str()
-        self.sync_engine_state()
+        self.analyzing = False
+
+        # The id of the latest analysis query. The lines of the older ones
+        # may still be in the queue and are dropped.
+        self.analysis_id = None
+
+        # Loading the weights may take seconds, so the engine is brought up
+        # in the background and the window shows at once. The engine is
+        # handed to the GUI thread after the handshake, and it is None
+        # until then.
+        self._lock = threading.Lock()
+        self._closing = False
+        self._started_engine = None
+        command = self._get_command(default_config.get("engine"))
+        if not command is None:
+            self.state = EngineState.STARTING
+            threading.Thread(
+                target=self._start_engine, args=(command,), daemon=True
+            ).start()
         self._bind()
 
     def _bind(self):
@@ -48,19 +61,57 @@ class EngineControls:
             cmd += " --use-optimistic-policy"
         return cmd
 
-    def _check_engine(self):
-        if not self.engine:
+    def _start_engine(self, command):
+        # Run in the background thread.
+        engine = None
+        try:
+            engine = GtpEngine(command)
+            if not self._check_engine(engine):
+                engine = None
+        except Exception as err:
+            sys.stderr.write("{}\n".format(str(err)))
+            sys.stderr.flush()
+            if not engine is None:
+                engine.shutdown()
+            engine = None
+
+        with self._lock:
+            if self._closing and not engine is None:
+                engine.quit()
+                engine.shutdown()
+                return
+            self._started_engine = engine
+        self._on_engine_started()
+
+    @mainthread
+    def _on_engine_started(self):
+        with self._lock:
+            engine = self._started_engine
+            self._started_engine = None
+            if self._closing:
+                return
+        if engine is None:
+            self.state = EngineState.FAILED
             return
-        name = self.engine.name()
+        self.engine = engine
+        self.state = EngineState.READY
+        self.sync_engine_state()
+
+    def _check_engine(self, engine):
+        name = engine.name()
         if name.lower() != "sayuri":
-            self.engine.quit()
-            self.engine.shutdown()
-            self.engine = None
+            engine.quit()
+            engine.shutdown()
             sys.stderr.write("Must be Sayuri engine.\n")
             sys.stderr.flush()
+            return False
+        return True
 
     def valid(self):
-        return not self.engine is None
+        return self.state == EngineState.READY
+
+    def get_state(self):
+        return self.state
 
     def get_mode(self):
         return self.parent.mode
@@ -75,9 +126,12 @@ class EngineControls:
             return
         board = self.parent.board
         self.analyzing = False
-        self.engine.send_command("clear_board")
-        self.engine.send_command("boardsize {}".format(board.board_size))
-        self.engine.send_command("komi {}".format(board.komi))
+        self.analysis_id = None
+        cmds = [
+            "clear_board",
+            "boardsize {}".format(board.board_size),
+            "komi {}".format(board.komi)
+        ]
 
         if board.scoring_rule == Board.SCORING_TERRITORY:
             scoring = "territory"
@@ -85,17 +139,13 @@ class EngineControls:
             scoring = "area"
         else:
             scoring = None
-        self.engine.send_command(
-                "sayuri-setoption name scoring rule value {}".format(scoring))
-
-        leaf_tag = self.parent.tree.get_tag()
-        curr = self.parent.tree.root
-        while leaf_tag != curr.get_tag():
-            curr = curr.default
-            col, vtx = curr.get_key().unpack()
-            self.do_action(
-                { "action" : "play", "color" : col, "vertex" : vtx }
-            )
+        cmds.append("sayuri-setoption name scoring rule value {}".format(scoring))
+
+        # The whole game is written in one batch.
+        for node in self.parent.tree.get_path()[1:]:
+            col, vtx = node.get_key().unpack()
+            cmds.append("play {} {}".format(col, vtx))
+        self.engine.send_commands(cmds)
 
     def do_action(self, action):
         if not self.engine:
@@ -123,9 +173,10 @@ class EngineControls:
         else:
             return
 
-        self.engine.send_command(gtp_command)
-        if action["action"] == "analyze":
-            time.sleep(0.05)
+        query = self.engine.send_command(gtp_command)
+        if query and \
+               (action["action"] == "analyze" or action["action"] == "genmove"):
+            self.analysis_id = query.id
 
     def handle_gtp_result(self):
         if not self.engine:
@@ -140,6 +191,8 @@ class EngineControls:
         playmove = None
         while not self.engine.analysis_empty():
             line = self.engine.get_analysis_line()
+            if line["id"] != self.analysis_id:
+                continue
             if line["type"] == "end":
                 self.analyzing = False
             elif line["type"] == "play":
@@ -153,7 +206,7 @@ class EngineControls:
             self.parent.tree.update_tag()
 
         if self.analyzing and last_line:
-            self.parent.tree.get_val()["analysis"] = AnalysisParser(last_line["data"])
+            self.parent.tree.set_analysis(AnalysisParser(last_line["data"]))
             self.parent.tree.update_tag()
             if self.parent.mode == GameMode.IDLE:
                 self.parent.engine.do_action({ "action" : "stop-analyze" })
@@ -165,6 +218,15 @@ class EngineControls:
             self.parent.engine.do_action({ "action" : "analyze", "color" : col })
 
     def on_request_close(self, *args, source=None):
+        with self._lock:
+            # The engine which is still starting is closed by the
+            # background thread.
+            self._closing = True
+            engine = self._started_engine
+            self._started_engine = None
+        if not engine is None:
+            engine.quit()
+            engine.shutdown()
         if not self.engine:
             return
         if self.analyzing:
@@ -1,7 +1,7 @@
 from kivy.uix.boxlayout import BoxLayout
 from .common import BackgroundColor, RectangleBorder
 from gui.common import draw_text, draw_circle
-from .common import GameMode
+from .common import GameMode, EngineState
 
 from theme import Theme
 from game.board import Board
@@ -58,6 +58,8 @@ class EngineInfoPanelWidget(BoxLayout, BackgroundColor, RectangleBorder):
                 name += " (playing)"
             self.name_label.text = name
             self.redraw()
+        elif self.engine.get_state() == EngineState.STARTING:
+            self.name_label.text = "Sayuri (starting...)"
         else:
             self.name_label.text = "NA"
 
@@ -16,6 +16,7 @@ from game.tree import Tree, NodeKey
 from game.board import Board
 from game.gtp import GtpEngine, GtpVertex
 from game.analysis import AnalysisParser
+from game.database import PositionIndex
 import game.sgf_parser as sgf_parser
 
 from gui.common import BackgroundColor, RectangleBorder
@@ -29,12 +30,15 @@ from gui.info_panel import EngineInfoPanelWidget, PlayerInfoPanelWidget
 from gui.engine import EngineControls
 
 from theme import Theme, replace_theme
-import sys, time
+import sys, time, os
 from enum import Enum
 
 kivy.config.Config.set("input", "mouse", "mouse,multitouch_on_demand")
 DefaultConfig = JsonStore("config.json")
 
+# Only every N-th node of the game tree keeps a full board.
+BOARD_CHECKPOINT_INTERVAL = 16
+
 class GamePanelWidget(BoxLayout, BackgroundColor, Screen):
     board = ObjectProperty(None)
     tree = ObjectProperty(None)
@@ -46,7 +50,10 @@ class GamePanelWidget(BoxLayout, BackgroundColor, Screen):
             DefaultConfig.get("game")["size"],
             DefaultConfig.get("game")["komi"],
             DefaultConfig.get("game")["rule"])
-        self.tree = Tree({ "board" : self.board.copy() })
+        self.tree = Tree(
+            { "board" : self.board.copy() },
+            checkpoint_interval=BOARD_CHECKPOINT_INTERVAL,
+            transposition=True)
         self.mode = GameMode.IDLE
         self.mode_temp = None
 
@@ -54,6 +61,19 @@ class GamePanelWidget(BoxLayout, BackgroundColor, Screen):
         self._bind()
         self.event = Clock.schedule_interval(self._loop, 0.025)
 
+        # The optional position index built by "python -m game.database".
+        self.position_index = None
+        if DefaultConfig.exists("database"):
+            index_path = DefaultConfig.get("database").get("index")
+            if index_path and os.path.isfile(index_path):
+                self.position_index = PositionIndex(index_path)
+
+    def search_position(self, max_games=None):
+        # Find the games of the current position and their next moves.
+        if self.position_index is None:
+            return None
+        return self.position_index.query(self.board, max_games)
+
     def _loop(self, *args):
         # When we leave the current page, all computational activities, including
         # analysis, must stop. We'll then save the current mode and resume its
@@ -95,7 +115,13 @@ class GamePanelWidget(BoxLayout, BackgroundColor, Screen):
 
     def load_sgf(self, sgf):
         try:
-            self.tree.copy_from(sgf_parser.load_sgf_as_tree(sgf, True))
+            # Build the board of the end of the main line before taking the
+            # tree. It validates the moves of the main line, so a file with
+            # an illegal one is rejected here. The other variations are
+            # checked when they are visited.
+            tree = sgf_parser.load_sgf_as_tree(sgf, True, BOARD_CHECKPOINT_INTERVAL, lazy=True)
+            tree.get_val()["board"]
+            self.tree.copy_from(tree)
             self.board.copy_from(self.tree.get_val()["board"])
             self.config.get("game")["size"] = self.board.board_size
             self.config.get("game")["komi"] = self.board.komi
@@ -228,8 +254,7 @@ class GameIOWidget(BoxLayout, BackgroundColor, Screen):
         self.source = path[0]
         try:
             with open(self.source, "r") as f:
-                sgf = f.read()
-            self.board.copy_from(sgf_parser.load_sgf_as_board(sgf, True))
+                self.board.copy_from(sgf_parser.load_sgf_as_board(f, True))
             self.simple_board_panel.on_size()
         except Exception:
             self.source = str()